@@ -0,0 +1,170 @@
+"""
+Action plugin in front of the easybuild module.
+
+The resolution of the easyconfig (search_eb/special_edit) only depends on the easyconfig
+repositories which are on shared storage. So it is done only once for all the hosts of the
+play: the first host reaching the task runs the module with resolve_only and the result is
+kept on the controller (in resolve_cache_dir, for resolve_cache_ttl seconds). All the hosts
+then run the module with the resolved package/options, so that the work done on each host
+is limited to the check of the module and the build.
+
+With group_by_feature (and use_cluster), the hosts are grouped by their slurm feature: the
+slurm jobs of hosts with the same feature are identical and install in the same tree. The
+first host of a group runs the build, the other hosts of the group wait for its result and
+then only check that the module is installed (verify_only).
+
+Options handled by the plugin (not passed to the module):
+  controller_resolve: (default:True) share the resolution between the hosts
+  resolve_cache_dir: (default:~/.ansible/easybuild_resolve) directory on the controller for the resolutions
+  resolve_cache_ttl: (default:900) validity (in second) of a resolution (and of the result of the build of a group)
+  group_by_feature: (default:False) build once per group of hosts with the same slurm feature (use_cluster)
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from ansible.plugins.action import ActionBase
+
+# arguments which define the result of the resolution
+RESOLVE_ARGS = ('search_eb', 'search_package', 'search_version', 'search_toolchain', 'strict_search',
+                'special_edit', 'special_edit_parameters', 'installpath_modules', 'installpath_source',
+                'robot', 'package')
+# arguments which define the build of a group of hosts (with the slurm feature): what is built and
+# where/how it is installed. The arguments of the search/special_edit are needed when they are not
+# resolved on the controller
+GROUP_ARGS = RESOLVE_ARGS + ('package_for_search', 'packages', 'installpath_software', 'additional_options',
+                             'force', 'use_cluster', 'job_backend', 'buildpath', 'buildpath_candidates',
+                             'artifact_store', 'hierarchical_modules', 'installpath_hierarchical')
+
+def is_true(value):
+    return value in (True, 'True', 'true', 'yes', 'on', '1', 1)
+
+@contextlib.contextmanager
+def locked(cache_dir, key):
+    """hold an exclusive lock (between the forks of the controller) on key"""
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass # created by another fork
+    with open(os.path.join(cache_dir, '%s.lock' % key), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def cache_key(args, names):
+    key = json.dumps(dict((arg, str(args.get(arg, ''))) for arg in names), sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def read_cache(cache_file, ttl):
+    """return the content of cache_file if younger than ttl seconds (None otherwise)"""
+    try:
+        if time.time() - os.stat(cache_file).st_mtime < ttl:
+            with open(cache_file) as handle:
+                return json.load(handle)
+    except (OSError, IOError, ValueError):
+        pass
+
+def write_cache(cache_file, content):
+    with open(cache_file + '.tmp', 'w') as handle:
+        json.dump(content, handle)
+    os.rename(cache_file + '.tmp', cache_file)
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        module_args = self._task.args.copy()
+        controller_resolve = is_true(module_args.pop('controller_resolve', True))
+        cache_dir = os.path.expanduser(module_args.pop('resolve_cache_dir', '~/.ansible/easybuild_resolve'))
+        ttl = int(module_args.pop('resolve_cache_ttl', 900))
+        group_by_feature = is_true(module_args.pop('group_by_feature', False))
+
+        # the files written by special_edit are only visible by all hosts in installpath_source
+        # (nothing is written in check mode, each host resolves it)
+        if controller_resolve and (is_true(module_args.get('search_eb'))
+                                   or (module_args.get('special_edit') and module_args.get('installpath_source')
+                                       and not self._play_context.check_mode)):
+            resolved = self._resolve(module_args, cache_dir, ttl, task_vars)
+            if resolved.get('failed') or resolved.get('skipped'):
+                result.update(resolved)
+                return result
+            module_args.update(package=resolved['eb_name'],
+                               package_for_search=resolved['eb_name_for_search'],
+                               additional_options=' '.join([module_args.get('additional_options', '')]
+                                                           + resolved['options']).strip(),
+                               search_eb=False, special_edit='')
+            result['resolved'] = resolved
+
+        if group_by_feature and is_true(module_args.get('use_cluster', True)) and not self._play_context.check_mode:
+            result.update(self._build_in_group(module_args, cache_dir, ttl, task_vars))
+            return result
+
+        result.update(self._execute_module(module_name='easybuild', module_args=module_args,
+                                           task_vars=task_vars))
+        return result
+
+    def _build_in_group(self, module_args, cache_dir, ttl, task_vars):
+        """run the build if this host is the first of its group (same slurm feature),
+           otherwise wait for the build of the group and check that the module is installed
+        """
+        host = task_vars.get('inventory_hostname')
+        feature = self._execute_module(module_name='easybuild', module_args=dict(module_args, feature_only=True),
+                                       task_vars=task_vars)
+        if feature.get('failed'):
+            return feature
+        feature = feature['feature']
+        key = cache_key(dict(module_args, feature=feature), GROUP_ARGS + ('feature',))
+        cache_file = os.path.join(cache_dir, 'group_%s.json' % key)
+
+        start = time.time()
+        with locked(cache_dir, 'group_' + key):
+            build = read_cache(cache_file, ttl)
+            # a failed build is only reused by the hosts which were waiting for it (no retry in the
+            # same run) but not by a later run
+            if build is None or (build['failed'] and build['time'] < start):
+                # this host is the representative of the group
+                result = self._execute_module(module_name='easybuild', module_args=module_args,
+                                              task_vars=task_vars)
+                build = dict(host=host, failed=bool(result.get('failed')), msg=result.get('msg', ''),
+                             time=time.time())
+                write_cache(cache_file, build)
+                result['group'] = dict(feature=feature, representative=host)
+                return result
+
+        group = dict(feature=feature, representative=build['host'])
+        if build['failed']:
+            return dict(failed=True, group=group,
+                        msg='build of the group failed on %s: %s' % (build['host'], build['msg']))
+        result = self._execute_module(module_name='easybuild', module_args=dict(module_args, verify_only=True),
+                                      task_vars=task_vars)
+        result['group'] = group
+        return result
+
+    def _resolve(self, module_args, cache_dir, ttl, task_vars):
+        """return the resolution of the package (from the cache of the controller if possible,
+           otherwise the module is run with resolve_only on the current host)
+        """
+        key = cache_key(module_args, RESOLVE_ARGS)
+        cache_file = os.path.join(cache_dir, '%s.json' % key)
+
+        # the other forks wait for the first one to resolve the package
+        with locked(cache_dir, key + '.json'):
+            resolved = read_cache(cache_file, ttl)
+            if resolved is not None:
+                return resolved
+
+            args = dict(module_args, resolve_only=True)
+            resolved = self._execute_module(module_name='easybuild', module_args=args, task_vars=task_vars)
+            resolved = dict((name, resolved[name]) for name in
+                            ('eb_name', 'eb_name_for_search', 'options', 'skipped', 'failed', 'msg')
+                            if name in resolved)
+            if not resolved.get('failed'):
+                write_cache(cache_file, resolved)
+            return resolved
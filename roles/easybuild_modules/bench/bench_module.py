@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Benchmark of the easybuild ansible module with fake eb/sinfo/squeue/sacct/sbatch/lmod.
+
+A synthetic module tree and easyconfig repository are created in a temporary directory,
+the fake executables (stub.py) are put first in the PATH and the module is run (as ansible
+does, with a json file as argument) for the following scenarios:
+    noop:         the module is already installed
+    search:       search_eb with a fallback on the toolchain/version (check mode)
+    special_edit: edit_openmpi_for_slurm (eb -Dr is faked, the edited OpenMPI is installed)
+    cluster:      submission of a missing package with use_cluster (eb --job is faked)
+For each scenario, the wall time of the module and the number/time of calls to each external
+tool are reported (the json report also contains the timings of each phase of the last run).
+
+usage: python bench_module.py [-n 5] [--latency eb=2 --latency sinfo=0.5] [--cold] [--json out.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOLS = ['eb', 'sinfo', 'squeue', 'sacct', 'scontrol', 'sbatch', 'scancel', 'lmod']
+
+def make_tree(tmpdir, n_modules, n_easyconfigs):
+    """create the synthetic module tree and easyconfig repository"""
+    modpath = os.path.join(tmpdir, 'modules')
+    ebpath = os.path.join(tmpdir, 'sources', 'eb_files')
+    for i in range(n_modules):
+        path = os.path.join(modpath, 'all', 'Pkg%d' % i)
+        os.makedirs(path)
+        open(os.path.join(path, '1.0-foss-2017a.lua'), 'w').close()
+    os.makedirs(os.path.join(modpath, 'all', 'foss'))
+    open(os.path.join(modpath, 'all', 'foss', '2017a.lua'), 'w').close()
+    os.makedirs(os.path.join(modpath, 'all', 'OpenMPI'))
+    open(os.path.join(modpath, 'all', 'OpenMPI', '2.0.2-GCC-6.3.0-2.27.lua'), 'w').close()
+
+    for i in range(n_easyconfigs):
+        path = os.path.join(ebpath, 'p', 'Pkg%d' % i)
+        os.makedirs(path)
+        for version in ('1.0', '1.1'):
+            open(os.path.join(path, 'Pkg%d-%s-foss-2017a.eb' % (i, version)), 'w').close()
+    for name, files in [('Boost', ['Boost-1.63.0-foss-2017a-Python-2.7.13.eb', 'Boost-1.64.0-intel-2017a.eb']),
+                        ('foss', ['foss-2017a.eb']),
+                        ('OpenMPI', ['OpenMPI-2.0.2-GCC-6.3.0-2.27.eb'])]:
+        path = os.path.join(ebpath, name[0].lower(), name)
+        os.makedirs(path)
+        for filename in files:
+            with open(os.path.join(path, filename), 'w') as handle:
+                handle.write("name = '%s'\nconfigopts = '--enable-shared'\n" % name)
+
+    os.makedirs(os.path.join(tmpdir, 'src'))
+    dryrun = os.path.join(tmpdir, 'dryrun.txt')
+    with open(dryrun, 'w') as handle:
+        handle.write('CFGS=%s\n' % ebpath)
+        handle.write(' * [x] $CFGS/o/OpenMPI/OpenMPI-2.0.2-GCC-6.3.0-2.27.eb (module: OpenMPI/2.0.2-GCC-6.3.0-2.27)\n')
+        handle.write(' * [x] $CFGS/f/foss/foss-2017a.eb (module: foss/2017a)\n')
+        handle.write(' * [ ] $CFGS/p/Pkg0/Pkg0-1.1-foss-2017a.eb (module: Pkg0/1.1-foss-2017a)\n')
+    return modpath, dryrun
+
+def make_bin(tmpdir):
+    """create the fake executables"""
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    for tool in TOOLS:
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as handle:
+            handle.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.join(HERE, 'stub.py'), tool))
+        os.chmod(path, 0o755)
+    return bindir
+
+def scenarios(tmpdir, modpath):
+    common = dict(installpath_modules=modpath,
+                  installpath_source=os.path.join(tmpdir, 'src'),
+                  buildpath=os.path.join(tmpdir, 'build'),
+                  cache_dir=os.path.join(tmpdir, 'cache'),
+                  use_cluster=False)
+    return [('noop', dict(common, package='foss-2017a.eb')),
+            ('search', dict(common, search_eb=True, search_package='Boost', search_version='1.66.0',
+                            search_toolchain='foss,2018a', _ansible_check_mode=True)),
+            ('special_edit', dict(common, special_edit='edit_openmpi_for_slurm',
+                                  special_edit_parameters='foss-2017a.eb')),
+            ('cluster', dict(common, package='Pkg0-1.1-foss-2017a.eb', use_cluster=True, job_poll_min=1))]
+
+def run_scenario(module, python, args, env, calls_file, workdir):
+    """run the module once, return its wall time, its result and the calls to the tools"""
+    args_file = os.path.join(workdir, 'args.json')
+    json.dump({'ANSIBLE_MODULE_ARGS': args}, open(args_file, 'w'))
+    if os.path.exists(calls_file):
+        os.remove(calls_file)
+    start = time.time()
+    p = subprocess.Popen([python, module, args_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = p.communicate()
+    elapsed = time.time() - start
+    try:
+        result = json.loads(stdout.decode().strip().split('\n')[-1])
+    except ValueError:
+        raise Exception('module failed:\n%s\n%s' % (stdout.decode(), stderr.decode()))
+    calls = {}
+    if os.path.exists(calls_file):
+        for line in open(calls_file):
+            tool, duration = line.split()
+            count, total = calls.get(tool, (0, 0.))
+            calls[tool] = (count + 1, total + float(duration))
+    return elapsed, result, calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--module', default=os.path.join(HERE, '..', 'library', 'easybuild.py'))
+    parser.add_argument('--python', default=sys.executable, help='interpreter used to run the module')
+    parser.add_argument('--latency', action='append', default=[], metavar='TOOL=SECONDS')
+    parser.add_argument('--modules', type=int, default=2000, help='number of installed modules')
+    parser.add_argument('--easyconfigs', type=int, default=2000, help='number of easyconfigs in the robot path')
+    parser.add_argument('--cold', action='store_true', help='remove the module caches before each run')
+    parser.add_argument('--only', action='append', default=[], help='run only this scenario')
+    parser.add_argument('--json', help='write the results in this file')
+    args = parser.parse_args()
+
+    latency = dict((item.split('=')[0], float(item.split('=')[1])) for item in args.latency)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        modpath, dryrun = make_tree(tmpdir, args.modules, args.easyconfigs)
+        bindir = make_bin(tmpdir)
+        calls_file = os.path.join(tmpdir, 'calls.txt')
+        env = dict(os.environ, PATH=bindir + os.pathsep + os.environ['PATH'],
+                   LMOD_CMD=os.path.join(bindir, 'lmod'), MODULEPATH='',
+                   BENCH_CALLS=calls_file, BENCH_DRYRUN=dryrun, BENCH_LATENCY=json.dumps(latency))
+
+        report = {}
+        print('%-14s %9s %9s %9s  %s' % ('scenario', 'min', 'median', 'max', 'external calls of the last run (count/time)'))
+        for name, module_args in scenarios(tmpdir, modpath):
+            if args.only and name not in args.only:
+                continue
+            timings = []
+            for _ in range(args.repeat):
+                # installed by the fake jobs of the cluster scenario
+                if os.path.exists(os.path.join(modpath, 'all', 'Pkg0', '1.1-foss-2017a.lua')):
+                    os.remove(os.path.join(modpath, 'all', 'Pkg0', '1.1-foss-2017a.lua'))
+                if args.cold:
+                    shutil.rmtree(module_args['cache_dir'], ignore_errors=True)
+                    shutil.rmtree(module_args['installpath_source'], ignore_errors=True)
+                    os.makedirs(module_args['installpath_source'])
+                elapsed, result, calls = run_scenario(args.module, args.python, module_args, env,
+                                                      calls_file, tmpdir)
+                if result.get('failed'):
+                    raise Exception('%s failed: %s' % (name, result.get('msg')))
+                timings.append(elapsed)
+            timings.sort()
+            report[name] = dict(min=timings[0], median=timings[len(timings)//2], max=timings[-1],
+                                phases=result.get('timings', {}),
+                                calls=dict((tool, dict(count=count, time=total))
+                                           for tool, (count, total) in calls.items()))
+            print('%-14s %8.3fs %8.3fs %8.3fs  %s' % (name, timings[0], timings[len(timings)//2], timings[-1],
+                  ', '.join('%s:%d/%.2fs' % (tool, count, total) for tool, (count, total) in sorted(calls.items()))
+                  or '-'))
+        if args.json:
+            json.dump(report, open(args.json, 'w'), indent=2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""
+Check the submission of a dependency graph with job_backend=sbatch against the fake sbatch/scancel.
+
+submit_slurm_jobs is fed a node list (as returned by easyconfig_graph, which needs the
+EasyBuild API) and the arguments of the sbatch calls recorded by stub.py are checked:
+    - the independent easyconfigs with the same resources are a single job array
+    - the other jobs depend (afterok) on the jobs/array tasks of their dependencies
+    - if a submission fails, the jobs already submitted are cancelled
+
+usage: python sbatch_graph.py [--module ../library/easybuild.py]
+"""
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from bench_module import HERE, make_bin
+
+NODES = [dict(spec='zlib-1.2.11.eb', module='zlib/1.2.11', deps=[]),
+         dict(spec='bzip2-1.0.6.eb', module='bzip2/1.0.6', deps=[]),
+         dict(spec='GCC-6.3.0-2.27.eb', module='GCC/6.3.0-2.27', deps=[]),
+         dict(spec='Boost-1.63.0.eb', module='Boost/1.63.0', deps=['zlib/1.2.11']),
+         dict(spec='Python-2.7.13.eb', module='Python/2.7.13', deps=['bzip2/1.0.6', 'Boost/1.63.0'])]
+
+def option(args, name):
+    """return the value of the sbatch option --name= in args (None if not given)"""
+    for arg in args:
+        if arg.startswith('--%s=' % name):
+            return arg.split('=', 1)[1]
+    return None
+
+def submit(module, tmpdir, fail=None):
+    """run submit_slurm_jobs on NODES, return the submitted jobs (or the exception) and the recorded calls"""
+    recorded = os.path.join(tmpdir, 'args.jsonl')
+    for path in (recorded, os.environ['BENCH_CALLS']):
+        if os.path.exists(path):
+            os.remove(path)
+    env = dict(os.environ, BENCH_ARGS=recorded)
+    if fail:
+        env['BENCH_SBATCH_FAIL'] = str(fail)
+    params = dict(job_cores=4, job_memory=0, job_walltime=6, walltime_margin=1.5, job_partition='batch',
+                  job_partitions=[], default_build_time=1800, build_times='', cache_dir=tmpdir,
+                  job_resources={'GCC': {'cores': 8}})
+    try:
+        jobs = module.submit_slurm_jobs(NODES, ['--robot=/x', '--parallel=4'], env,
+                                        os.path.join(tmpdir, 'logs'), 'bench', params)
+    except Exception as error:
+        jobs = error
+    calls = [json.loads(line) for line in open(recorded)] if os.path.exists(recorded) else []
+    return jobs, calls
+
+def check(name, condition):
+    print('%-60s %s' % (name, 'ok' if condition else 'FAILED'))
+    return condition
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--module', default=os.path.join(HERE, '..', 'library', 'easybuild.py'))
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bindir = make_bin(tmpdir)
+        os.environ.update(PATH=bindir + os.pathsep + os.environ['PATH'],
+                          BENCH_CALLS=os.path.join(tmpdir, 'calls.txt'))
+        module = imp.load_source('easybuild_module', args.module)
+
+        ok = True
+        jobs, calls = submit(module, tmpdir)
+        sbatch = [call_args for tool, call_args in calls if tool == 'sbatch']
+        by_module = dict((mod, jobid) for jobid, mod in jobs.items())
+        arrays = [call_args for call_args in sbatch if option(call_args, 'array')]
+        ok &= check('4 sbatch calls for 5 easyconfigs', len(sbatch) == 4)
+        ok &= check('zlib and bzip2 in one job array', len(arrays) == 1 and option(arrays[0], 'array') == '0-1'
+                    and by_module['zlib/1.2.11'].split('_')[0] == by_module['bzip2/1.0.6'].split('_')[0])
+        ok &= check('GCC (other resources) alone', '_' not in by_module['GCC/6.3.0-2.27'])
+        ok &= check('Boost afterok on the zlib array task',
+                    option(sbatch[2], 'dependency') == 'afterok:%s' % by_module['zlib/1.2.11'])
+        ok &= check('Python afterok on the bzip2 array task and on Boost',
+                    option(sbatch[3], 'dependency') == 'afterok:%s:%s' % (by_module['bzip2/1.0.6'],
+                                                                          by_module['Boost/1.63.0']))
+        ok &= check('no scancel', not [tool for tool, _ in calls if tool == 'scancel'])
+
+        error, calls = submit(module, tmpdir, fail=3)
+        cancelled = sorted(call_args[0] for tool, call_args in calls if tool == 'scancel')
+        ok &= check('failed submission raises', isinstance(error, Exception))
+        ok &= check('the 2 jobs submitted before the failure are cancelled',
+                    cancelled == ['2000', '2001'] and len([tool for tool, _ in calls if tool == 'sbatch']) == 3)
+    finally:
+        shutil.rmtree(tmpdir)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Measure the startup time of the easybuild ansible module.
+
+The module is run (as ansible does, with a json file as argument) in check mode on a
+synthetic module tree where the module is already installed. This is the path taken by
+every idempotent re-run. The time is compared to the cost of importing and configuring
+EasyBuild (which was done at import of the module before it was made lazy).
+
+usage: python startup_time.py [-n 10] [--module ../library/easybuild.py]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def timeit(cmd, repeat, env=None):
+    """return the list of wall time of cmd (in second)"""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        stdout, stderr = p.communicate()
+        timings.append(time.time() - start)
+        if p.returncode:
+            raise Exception('%s failed:\n%s\n%s' % (' '.join(cmd), stdout, stderr))
+    return sorted(timings)
+
+def report(name, timings):
+    print('%-40s min %7.3fs  median %7.3fs  max %7.3fs' % (name, timings[0], timings[len(timings)//2], timings[-1]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--repeat', type=int, default=10)
+    parser.add_argument('--module', default=os.path.join(HERE, '..', 'library', 'easybuild.py'))
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        modpath = os.path.join(tmpdir, 'modules')
+        os.makedirs(os.path.join(modpath, 'all', 'foss'))
+        open(os.path.join(modpath, 'all', 'foss', '2017a.lua'), 'w').close()
+        os.makedirs(os.path.join(tmpdir, 'sources', 'eb_files'))
+        args_file = os.path.join(tmpdir, 'args.json')
+        json.dump({'ANSIBLE_MODULE_ARGS': {'package': 'foss-2017a.eb',
+                                           'installpath_modules': modpath,
+                                           'cache_dir': os.path.join(tmpdir, 'cache'),
+                                           'buildpath': os.path.join(tmpdir, 'build'),
+                                           'use_cluster': False,
+                                           '_ansible_check_mode': True}},
+                  open(args_file, 'w'))
+
+        report('module (check mode, installed)',
+               timeit([sys.executable, args.module, args_file], args.repeat))
+        try:
+            report('EasyBuild import + set_up_configuration',
+                   timeit([sys.executable, '-c',
+                           'import os; os.chdir("/tmp"); import easybuild;'
+                           'from easybuild.tools.options import set_up_configuration;'
+                           'set_up_configuration(silent=True)'], args.repeat))
+        except Exception as error:
+            print('EasyBuild configuration can not be timed: %s' % error)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
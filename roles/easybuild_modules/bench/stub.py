@@ -0,0 +1,93 @@
+"""
+Fake eb/sinfo/squeue/sacct/scontrol/sbatch/scancel/lmod used by bench_module.py
+
+usage: python stub.py <tool> [arguments of the tool]
+
+The behaviour is controlled by environment variables:
+    BENCH_CALLS: file where each call is recorded (one line "<tool> <duration>")
+    BENCH_LATENCY: json dictionary tool -> latency in second (default 0)
+    BENCH_DRYRUN: file with the output of 'eb -Dr'
+    BENCH_FEATURE: slurm feature of the local node (default "bench")
+    BENCH_ARGS: file where the arguments of each call are recorded (one json line [tool, args])
+    BENCH_SBATCH_FAIL: the n-th call of sbatch (counted in BENCH_ARGS) fails
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+
+def eb(args):
+    if '-Dr' in args or '--dry-run' in args:
+        sys.stdout.write(open(os.environ['BENCH_DRYRUN']).read())
+    elif '--job' in args:
+        names = [os.path.basename(arg)[:-3] for arg in args if arg.endswith('.eb')]
+        jobs = ['%s (%s): %s' % (name, name.replace('-', '/', 1), 1000 + i) for i, name in enumerate(names)]
+        print('== List of submitted jobs (%d): %s' % (len(jobs), ', '.join(jobs)))
+        # the jobs (reported COMPLETED by sacct) install the modules
+        for arg in args:
+            if arg.startswith('--installpath-modules='):
+                for name in names:
+                    path = os.path.join(arg.split('=', 1)[1], 'all', name.replace('-', '/', 1) + '.lua')
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    open(path, 'w').close()
+    else:
+        print('== COMPLETED: Installation ended successfully')
+
+def sinfo(args):
+    hostname = socket.gethostname().split('.')[0]
+    for i in range(50):
+        print('node%03d|bench' % i)
+    print('%s|%s' % (hostname, os.environ.get('BENCH_FEATURE', 'bench')))
+
+def squeue(args):
+    pass # all the jobs are finished
+
+def sacct(args):
+    job_ids = args[args.index('-j') + 1].split(',')
+    for jobid in job_ids:
+        print('%s|COMPLETED' % jobid)
+
+def scontrol(args):
+    sys.exit(1)
+
+def sbatch(args):
+    recorded = os.environ.get('BENCH_ARGS')
+    if recorded and os.path.exists(recorded) and os.environ.get('BENCH_SBATCH_FAIL'):
+        count = len([line for line in open(recorded) if json.loads(line)[0] == 'sbatch'])
+        if count == int(os.environ['BENCH_SBATCH_FAIL']):
+            sys.stderr.write('sbatch: error: Batch job submission failed\n')
+            sys.exit(1)
+    # job ids from the number of calls already recorded
+    calls = os.environ.get('BENCH_CALLS')
+    count = len(open(calls).readlines()) if calls and os.path.exists(calls) else 0
+    print('%s;bench' % (2000 + count))
+
+def scancel(args):
+    pass
+
+def lmod(args):
+    if '--version' in args:
+        sys.stderr.write('Modules based on Lua: Version 7.8.0 2018-10-30\n')
+
+TOOLS = dict(eb=eb, sinfo=sinfo, squeue=squeue, sacct=sacct, scontrol=scontrol, sbatch=sbatch, scancel=scancel,
+             lmod=lmod)
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    start = time.time()
+    time.sleep(json.loads(os.environ.get('BENCH_LATENCY', '{}')).get(tool, 0))
+    if os.environ.get('BENCH_ARGS'):
+        with open(os.environ['BENCH_ARGS'], 'a') as recorded:
+            recorded.write(json.dumps([tool, args]) + '\n')
+    try:
+        TOOLS[tool](args)
+    finally:
+        if os.environ.get('BENCH_CALLS'):
+            with open(os.environ['BENCH_CALLS'], 'a') as calls:
+                calls.write('%s %.6f\n' % (tool, time.time() - start))
+
+if __name__ == '__main__':
+    main()
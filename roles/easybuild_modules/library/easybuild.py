@@ -2,8 +2,8 @@
 
 import os 
 import re
+import json
 import time
-from distutils.version import LooseVersion
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.21',
@@ -42,15 +42,96 @@ EXAMPLES = '''
 - easybuild: name/path of the easyconfig file (should follow standard convention) 
   installpath_modules: path where to install the modules (needed to check if nothing has to be done)
 
+# installation of a full stack in one eb run
+- easybuild:
+  packages: [foss-2017a.eb, Boost-1.63.0-foss-2017a-Python-2.7.13.eb]
+  installpath_modules: path where to install the modules
+
 # example with full parameter
 - package: name/path of the easyconfig file (should follow standard convention) 
   installpath_modules: path where to install the modules (needed to check if nothing has to be done)
   installpath_software: path where to install the software
   installpath_source: path where to install the source
+  buildpath: (default:<first candidate with enough space>/<hostname>) path where eb builds the software
+  buildpath_candidates: (default:[]) directories (fastest first, e.g. /dev/shm, local scratch) to use as buildpath.
+                        The first one with build_size GB available is used (fallback: ~soft/build).
+                        With use_cluster, the free space is checked on the host, not on the compute node
+  build_size: (default:10 times the size of the sources in installpath_source, 10 if unknown) space (in GB) 
+              needed by the build
+  build_purge_age: (default:7) after a build, remove the build trees of the host (in all the candidates)
+                   not modified since that number of days (0: no cleanup)
+  packages: list of easyconfig to install in a single eb run (the missing set is computed once for all of them). 
+            Can not be combined with search_eb/special_edit
   robot: (default:True) to activate '--robot' option
   force: (default:False) run eb command even if the module is already found in the correct path.
   keep_std: (default:False) keep stdout/stderr for sucessfull completion
   additional_options: add aditional options to eb command. Note that command changing name to the create module requires "force" options
+  resolve_only: (default:False) only run search_eb/special_edit and return eb_name, eb_name_for_search 
+                and options (used by the action plugin to resolve a package once for all hosts)
+  special_edit: function editing an easyconfig (edit_openmpi_for_slurm, special_amend) with special_edit_parameters.
+                The edited easyconfig is kept in <installpath_source or cache_dir>/derived/<hash>/ (hash of the 
+                original easyconfig, the function and the parameters) and reused while the original is unchanged
+  package_for_search: name of the eb to use to check if the module is already installed (default: package)
+  lock_lease: (default:120) the modules to install are locked with a lease file in installpath_modules/.locks
+              (refreshed every lock_lease/3 seconds, a lease older than lock_lease is stolen). A concurrent 
+              run of the same module waits for the result of the first one instead of building again.
+              0 disables the lock
+  lock_wait: (default:0, no limit) maximal time (in second) to wait for a lock
+  hierarchical_modules: (default:False) after the build (or if the packages are already installed), generate 
+                        (eb --module-only, MigrateFromEBToHMNS) the modules of the hierarchical scheme missing for 
+                        the dependency graph of the packages.
+                        The software is not rebuilt. Independent modules are generated concurrently.
+                        Not available with the --try-* options
+  installpath_hierarchical: (default:<installpath_modules>_hierarchical) path of the hierarchical modules
+  build_times: (default:<cache_dir>/build_times.json) history of the build times (in second) by easyconfig, toolchain
+               and slurm feature, filled from the elapsed time of the slurm jobs (sacct) and of the local_parallel
+               builds. Used for the walltime/partition of the jobs and for the estimated time of the check mode
+  default_build_time: (default:1800) build time (in second) used for the modules not in build_times
+  feature_only: (default:False) only return the slurm feature of the host (used by the action plugin 
+                to group the hosts which build for the same feature)
+  verify_only: (default:False) do not build, fail if the module is not installed (used by the action 
+               plugin for the hosts of a group which waited for the build of another host)
+  search_list: list of dictionary (package/version/toolchain) to resolve in one go (as search_eb). 
+               No installation is done, the result is returned in 'resolved'.
+  prefetch: (default:False) download the sources of all the missing easyconfigs in installpath_source 
+            (concurrently, with checksum verification) before running eb. The easyconfigs tweaked by
+            the --try-* options are not prefetched
+  prefetch_workers: (default:8) number of concurrent downloads/verifications
+  source_mirror: directory, file:// or http(s):// url where to look for the sources before the 
+                 source_urls of the easyconfig (same layout as installpath_source, or flat)
+  artifact_store: directory (local or shared) with tarballs of installed software+module keyed by the 
+                  checksum of the easyconfig, the toolchain, the slurm feature and installpath_software.
+                  Missing dependencies are restored from it before running eb and new builds are added 
+                  to it (requires installpath_software)
+  local_parallel: (default:False) without use_cluster, build the missing easyconfigs of the dependency graph
+                  concurrently on the local node (an easyconfig starts as soon as its dependencies are installed).
+                  Not available with the --try-* options (search_eb or additional_options)
+  local_cores: (default:number of cores) number of cores that the concurrent builds can use
+  local_memory: (default:0, no limit) memory (in GB) that the concurrent builds can use
+  job_cores: (default:4) number of cores of each build (--parallel, overwritten by --parallel in additional_options)
+  job_memory: (default:0) memory (in GB) reserved for each build
+  job_backend: (default:easybuild) with use_cluster, 'easybuild' submits the jobs with 'eb --job'. 'sbatch' submits
+               one sbatch job per missing easyconfig of the dependency graph (job arrays for the independent 
+               ones with the same resources), chained with --dependency=afterok, all at once
+               (not available with the --try-* options)
+  job_walltime: (default:6) walltime (in hour) of the jobs without build history. With a history (see build_times), 
+                the walltime is the longest known build time times walltime_margin
+  walltime_margin: (default:1.5) safety margin on the walltime predicted from the history
+  job_partition: (default:batch,debug) slurm partition(s) of the jobs (without job_partitions)
+  job_partitions: (default:[]) partitions as list of {name:, max_walltime: (hour)}. Each job goes to the 
+                  partition with the shortest max_walltime allowing its walltime
+  job_resources: (default:{}) resources of the jobs (sbatch backend) by software name or module, overwriting 
+                 job_cores/job_memory/job_walltime e.g. {GCC: {cores: 16, walltime: 12}, 'Qt5/5.10.1': {memory: 32}}
+  slurm_feature: feature(s) of the host used as constraint of the slurm jobs (use_cluster). 
+                 By default obtained from sinfo (one call for all nodes, cached in cache_dir)
+  feature_cache_ttl: (default:3600) validity (in second) of the cached sinfo node->feature map
+  job_poll_min: (default:10) first polling interval (in second) of the slurm jobs submitted by eb (use_cluster)
+  job_poll_max: (default:300) maximal polling interval (the interval grows by 50% at each check)
+  trace_file: append a json line with the host, the timings and the external commands of the task 
+              to that file (to aggregate the traces of many hosts/tasks)
+  cache_dir: (default:~/.cache/ansible_easybuild) directory for the on-disk caches (catalog of the easyconfig available in the robot path,...)
+  log_dir: (default:<cache_dir>/logs) directory where the full stdout/stderr of eb is written
+  std_tail_lines: (default:500) number of lines of stdout/stderr kept in the result
    module_path: force module path
 '''
 
@@ -62,22 +143,149 @@ message:
     description: some status report of the ansible module
     type: str
 stdout:
-    description: stdout of the eb process (not fill if retruncode is zero)
+    description: last std_tail_lines lines of the stdout of the eb process (not fill if retruncode is zero)
     type: str
 stderr:
-    description: stderr of the eb process (not fill if retruncode is zero)
+    description: last std_tail_lines lines of the stderr of the eb process (not fill if retruncode is zero)
+    type: str
+log_file:
+    description: file with the full stdout/stderr of the eb process
+    type: str
+missing:
+    description: (only with packages or in check mode) modules missing in the combined dependency graph of the packages
+    type: list
+feature:
+    description: (only with use_cluster or feature_only) slurm feature used as constraint of the jobs
+    type: str
+plan:
+    description: (only in check mode) missing modules of the dependency graph in installation order
+                 (module, easyconfig, try_options, dependencies_known, estimated_time, history). Computed from the cached 
+                 dry runs, without running eb (only the package itself if its dry run was never cached)
+    type: list
+estimated_time:
+    description: (only in check mode) estimated build time (in second) of the plan
+    type: int
+modules_dir:
+    description: module directories modified by the installation (touched of lmod_spider_cache)
+    type: list
+hierarchical:
+    description: (only with hierarchical_modules) generation of each hierarchical module (module, state, returncode, log_file)
+    type: list
+buildpath:
+    description: (without buildpath) build directory chosen among buildpath_candidates
+    type: str
+purged:
+    description: stale build trees removed after the build
+    type: list
+waited_for:
+    description: modules installed by a concurrent run (module -> host) during the wait for the lock
+    type: dict
+partition:
+    description: (only with use_cluster and the easybuild job_backend) partition chosen for the jobs
     type: str
+jobs:
+    description: (only with use_cluster) slurm jobs submitted by eb or by the module (jobid -> name and final state)
+    type: dict
+job_log:
+    description: (only if a slurm job failed) output file of the failing job
+    type: str
+builds:
+    description: (only with local_parallel) state (ok/failed/skipped), returncode and log_file of each build
+    type: list
+prefetch:
+    description: (only with prefetch) status (present/downloaded/failed) of each source file
+    type: list
+restored:
+    description: (only with artifact_store) modules restored from the artifact store
+    type: list
+published:
+    description: (only with artifact_store) modules added to the artifact store
+    type: list
+eb_name:
+    description: (only with resolve_only) easyconfig to give to eb
+    type: str
+eb_name_for_search:
+    description: (only with resolve_only) easyconfig associated to the module to check
+    type: str
+options:
+    description: (only with resolve_only) additional options (--try-*) to give to eb
+    type: list
+timings:
+    description: wall time (in second) of each phase of the module (setup, resolution, module_check, 
+                 slurm_feature, dry_run, artifact_restore, prefetch, build, job_wait, artifact_publish, total,...)
+                 easybuild_setup and eb_config_path are included in the phase where they occur
+    type: dict
+commands:
+    description: external commands spawned by the module with their duration and returncode
+    type: list
+resolved:
+    description: (only with search_list) for each entry of search_list, the eb_name, eb_name_for_search and options found (eb_name is null if nothing found)
+    type: list
 '''
 
 import os
 import subprocess
 from ansible.module_utils.basic import AnsibleModule
 
-# to allow to use easybuild as an API, you need to do something like
-import easybuild
-from easybuild.tools.options import set_up_configuration; 
 os.chdir('/tmp')
-set_up_configuration(silent=True)
+
+#
+# timing of each phase of the module and of each external command 
+#
+_trace = dict(start=time.time(), last=time.time(), timings={}, commands=[])
+
+def end_phase(name):
+    """record the wall time since the end of the previous phase as the time of the phase name"""
+    now = time.time()
+    add_timing(name, now - _trace['last'])
+    _trace['last'] = now
+
+def add_timing(name, duration):
+    _trace['timings'][name] = _trace['timings'].get(name, 0) + duration
+
+def record_command(cmd, start, returncode):
+    _trace['commands'].append(dict(command=' '.join(cmd), duration=time.time() - start,
+                                   returncode=returncode))
+
+def with_trace(exit_function, params):
+    """wrap exit_json/fail_json to add the timings/commands to the result 
+       (and write them in the trace file)
+    """
+    failed = exit_function.__name__ == 'fail_json'
+    def traced_exit(**result):
+        end_phase('failure' if failed else 'exit')
+        result['timings'] = dict(_trace['timings'], total=time.time() - _trace['start'])
+        result['commands'] = _trace['commands']
+        if params['trace_file']:
+            import socket
+            trace = dict(host=socket.gethostname(), time=_trace['start'],
+                         package=params['package'] or params['packages'] or params['search_package'],
+                         changed=result.get('changed'), failed=failed,
+                         timings=result['timings'], commands=result['commands'])
+            try:
+                with open(os.path.expanduser(params['trace_file']), 'a') as out:
+                    out.write(json.dumps(trace) + '\n')
+            except IOError:
+                pass
+        return exit_function(**result)
+    return traced_exit
+
+# to allow to use easybuild as an API, you need to do something like
+# this is slow so this is only done when a code path really needs it
+# (_eb_configured keeps the options of the current configuration)
+_eb_configured = []
+def setup_easybuild(args=None, reconfigure=False):
+    """import and configure easybuild with the eb command line options args.
+       This is done again only if args differ from the current configuration (or if reconfigure)
+    """
+    args = list(args or [])
+    if not _eb_configured or reconfigure or _eb_configured[0] != args:
+        start = time.time()
+        import easybuild
+        from easybuild.tools.options import set_up_configuration
+        set_up_configuration(args=args, silent=True, reconfigure=bool(_eb_configured))
+        _eb_configured[:] = [args]
+        add_timing('easybuild_setup', time.time() - start)
 
 def run_module():
     # define the available arguments/parameters that a user can pass to
@@ -86,10 +294,17 @@ def run_module():
     
     module_args = dict(
         package=dict(type='str', required=False, default=''),
+        # list of easyconfig to install together (one eb run for all of them)
+        packages=dict(type='list', required=False, default=[]),
         installpath_modules=dict(type='str', required=True),
         installpath_software=dict(type='str', required=False, default=''),
         installpath_source=dict(type='str', required=False, default=''),
         buildpath=dict(type='str', required=False, default=''),
+        # without buildpath: directories to build in (by order of preference), size (in GB) needed for 
+        # the build (default: estimated) and age (in day) of the build trees to remove after the build
+        buildpath_candidates=dict(type='list', required=False, default=[]),
+        build_size=dict(type='int', required=False, default=0),
+        build_purge_age=dict(type='int', required=False, default=7),
         robot=dict(type='bool',required=False, default=True),
         additional_options=dict(type='str', required=False, default=''),
         force=dict(type='bool', required=False, default=False),
@@ -100,11 +315,62 @@ def run_module():
         search_version=dict(type='str', required=False, default=''),
         search_toolchain=dict(type='str', required=False, default=''),
         strict_search=dict(type='bool', required=False, default=False),
+        # list of {package:, version:, toolchain:} to resolve in one go
+        search_list=dict(type='list', required=False, default=[]),
         special_edit=dict(type='str', required=False, default=''),
         special_edit_parameters=dict(type='str', required=False, default=''),
+        # only run search_eb/special_edit and return the result (used by the action plugin)
+        resolve_only=dict(type='bool', required=False, default=False),
+        # name of the eb to use to check if the package is installed (default: package)
+        package_for_search=dict(type='str', required=False, default=''),
+        # lease (in second) of the lock on the modules to install (0: no lock) and maximal wait (0: no limit)
+        lock_lease=dict(type='int', required=False, default=120),
+        lock_wait=dict(type='int', required=False, default=0),
+        # generation of the modules of the hierarchical scheme (module only, no rebuild)
+        hierarchical_modules=dict(type='bool', required=False, default=False),
+        installpath_hierarchical=dict(type='str', required=False, default=''),
+        # known build times (json module -> seconds) used to estimate the plan of the check mode
+        build_times=dict(type='str', required=False, default=''),
+        default_build_time=dict(type='int', required=False, default=1800),
+        # used by the action plugin to build once per group of hosts with the same slurm feature
+        feature_only=dict(type='bool', required=False, default=False),
+        verify_only=dict(type='bool', required=False, default=False),
         # handling of the cluster
         use_cluster=dict(type='bool', required=False, default=True),
+        # parallel build of the dependencies on the local node (use_cluster=False)
+        local_parallel=dict(type='bool', required=False, default=False),
+        local_cores=dict(type='int', required=False, default=0),
+        local_memory=dict(type='int', required=False, default=0),
+        job_cores=dict(type='int', required=False, default=4),
+        job_memory=dict(type='int', required=False, default=0),
+        # submission of the slurm jobs (use_cluster): by 'eb --job' or by the module (sbatch)
+        job_backend=dict(type='str', required=False, default='easybuild', choices=['easybuild', 'sbatch']),
+        job_walltime=dict(type='int', required=False, default=6),
+        job_partition=dict(type='str', required=False, default='batch,debug'),
+        # partitions ({name:, max_walltime:}) to choose from the walltime predicted by the build history
+        job_partitions=dict(type='list', required=False, default=[]),
+        walltime_margin=dict(type='float', required=False, default=1.5),
+        job_resources=dict(type='dict', required=False, default={}),
+        # slurm feature of the host (default: from sinfo, cached for feature_cache_ttl seconds)
+        slurm_feature=dict(type='str', required=False, default=''),
+        feature_cache_ttl=dict(type='int', required=False, default=3600),
         fetch=dict(type='bool', required=False, default=False),
+        # concurrent download of the sources before running eb
+        prefetch=dict(type='bool', required=False, default=False),
+        prefetch_workers=dict(type='int', required=False, default=8),
+        source_mirror=dict(type='str', required=False, default=''),
+        # directory where the installed software are stored/restored
+        artifact_store=dict(type='str', required=False, default=''),
+        # polling interval (in second) of the state of the slurm jobs (grows from min to max)
+        job_poll_min=dict(type='int', required=False, default=10),
+        job_poll_max=dict(type='int', required=False, default=300),
+        # json trace (one line per task) with the timings and the external commands
+        trace_file=dict(type='str', required=False, default=''),
+        # directory where to keep the on-disk caches (easyconfig catalog, ...)
+        cache_dir=dict(type='str', required=False, default='~/.cache/ansible_easybuild'),
+        # full output of eb is written in log_dir, only the end is kept in memory
+        log_dir=dict(type='str', required=False, default=''),
+        std_tail_lines=dict(type='int', required=False, default=500),
 #        module_path=dict(type='str', required=False, default=''),
         )
 
@@ -132,22 +398,37 @@ def run_module():
         argument_spec=module_args,
         supports_check_mode=True
     )
+    ans_module.exit_json = with_trace(ans_module.exit_json, ans_module.params)
+    ans_module.fail_json = with_trace(ans_module.fail_json, ans_module.params)
+    end_phase('setup')
+
+    if ans_module.params['feature_only']:
+        hostname, result['feature'] = host_slurm_feature(ans_module.params)
+        end_phase('slurm_feature')
+        if not result['feature']:
+            return ans_module.fail_json(msg='no slurm feature found for node %s' % hostname, **result)
+        return ans_module.exit_json(**result)
+
+    #
+    # resolution of a full list of package (no installation)
+    #
+    if ans_module.params['search_list']:
+        try:
+            result['resolved'] = search_eb_modules(ans_module.params['search_list'], ans_module.params)
+        except ValueError as error:
+            return ans_module.fail_json(msg=str(error), **result)
+        end_phase('resolution')
+        return ans_module.exit_json(**result)
 
 #    if ans_module.params['module_path']:
 #        import os
 #        os.environ['MODULEPATH'] = ans_module.params['module_path']
 
 
-    eb_name = ans_module.params['package']
-    if (eb_name.startswith('./') or eb_name.count('/') > 1) and \
-            eb_name.endswith('.eb') and \
-            not os.path.exists(eb_name):
-        # the file should have been moved to the eb_repo which is in the robot path
-        if ans_module.params['robot']:
-            eb_name = eb_name.rsplit('/',1)[1]
+    eb_name = clean_eb_name(ans_module.params['package'], ans_module.params['robot'])
 
     otherargs = ans_module.params['additional_options']
-    eb_name_for_search = eb_name
+    eb_name_for_search = ans_module.params['package_for_search'] or eb_name
 
     search_eb = ans_module.params['search_eb']
     edit_eb_config = ans_module.params['special_edit']
@@ -171,11 +452,39 @@ def run_module():
     #   Handling special function to edit the easyconfig file.
     #
     elif edit_eb_config:
-        eb_name, new_eb_name_for_search = eval('%s(ans_module.params)' % edit_eb_config)
+        # in check mode, eb is not run and the derived easyconfig is not written
+        edit_params = dict(ans_module.params, check_mode=ans_module.check_mode)
+        eb_name, new_eb_name_for_search = eval('%s(edit_params)' % edit_eb_config)
         if new_eb_name_for_search:
             eb_name_for_search = new_eb_name_for_search
+        if not eb_name and ans_module.check_mode:
+            # the upstream easyconfig is only known from a dry run of eb (not in the cache)
+            result['changed'] = True
+            result['message'] = 'easyconfig of %s unknown without running eb' % edit_eb_config
+            result['plan'] = [dict(module=None, easyconfig=None, try_options=[], dependencies_known=False,
+                                   estimated_time=ans_module.params['default_build_time'], history=False)]
+            return ans_module.exit_json(**result)
         if not eb_name:
             ans_module.fail_json(msg='eb program failed', **result)
+    end_phase('resolution')
+
+    if ans_module.params['resolve_only']:
+        result.update(eb_name=eb_name, eb_name_for_search=eb_name_for_search,
+                      options=const if search_eb else [])
+        return ans_module.exit_json(**result)
+
+    #
+    #   Handling of a list of package (installed together)
+    #
+    packages = ans_module.params['packages']
+    if packages and (search_eb or edit_eb_config):
+        return ans_module.fail_json(msg='packages can not be combined with search_eb/special_edit', **result)
+    elif packages:
+        eb_names = [clean_eb_name(eb, ans_module.params['robot']) for eb in packages]
+        eb_names_for_search = eb_names
+    else:
+        eb_names = [eb_name]
+        eb_names_for_search = [eb_name_for_search]
 
     modpath = ans_module.params['installpath_modules']
     force_eb = ans_module.params['force']
@@ -187,39 +496,50 @@ def run_module():
     #        or event better use eb routine to check if the module need change
     #  currently force that path as input and check if the module exists.
     
-    # replace the first "-" by a "/" and remove .eb to pass from eb name 
-    #to  module name 
-    if eb_name_for_search.endswith('.eb'):
-        mod_name = eb_name_for_search[:-3]
-    else:
-        mod_name = eb_name_for_search
-    if '/' in mod_name:
-        mod_name = mod_name.rsplit('/',1)[1]
-    mod_name = mod_name.split("-",1)
-
-    import easybuild.tools.modules as modules
-    #import easybuild.tools.config as config
-    #config.build_option()
-        #config.init_build_options()
     if 'MODULEPATH' in os.environ:
         paths = os.environ['MODULEPATH']
         paths = ans_module.params['installpath_modules'] + "/all:" + paths
     else:
         paths=''
         paths = ans_module.params['installpath_modules'] + "/all"
-    modhandler = modules.modules_tool(mod_paths=paths.split(':'))
-    if not modhandler:
-        ans_module.fail_json(msg='Fail to get a module handler', **result)
-    elif not modhandler.exist(['/'.join(mod_name)])[0]:
+    # in check mode, the module name is guessed for non standard easyconfig names (no easybuild setup)
+    mod_names = [eb_to_module_name(eb, strict=not ans_module.check_mode) for eb in eb_names_for_search]
+    if all(mod_names) and default_naming_scheme(otherargs):
+        # fast path: look directly for the module file
+        exists = [module_exists(mod_name, paths.split(':')) for mod_name in mod_names]
+    else:
+        setup_easybuild(eb_robot_options(modpath) + otherargs.split())
+        import easybuild.tools.modules as modules
+        #import easybuild.tools.config as config
+        #config.build_option()
+            #config.init_build_options()
+        modhandler = modules.modules_tool(mod_paths=paths.split(':'))
+        if not modhandler:
+            ans_module.fail_json(msg='Fail to get a module handler', **result)
+        mod_names = [mod_name or eb_to_module_name(eb, strict=False)
+                     for mod_name, eb in zip(mod_names, eb_names_for_search)]
+        exists = modhandler.exist(mod_names)
+    to_install = [eb for eb, exist in zip(eb_names, exists) if not exist]
+    install_modules = dict(zip(eb_names, mod_names))
+    if ans_module.params['verify_only']:
+        end_phase('module_check')
+        result['log'] = ','.join(mod_names)
+        if to_install:
+            return ans_module.fail_json(msg='module not installed: %s' %
+                                        ','.join(install_modules[eb] for eb in to_install), **result)
+        result['message'] = 'module installed (build done by another host)'
+        return ans_module.exit_json(**result)
+    if to_install:
         result['changed'] = True
     else :
-        result['message'] = 'module already installed:', str(modhandler.exist(['/'.join(mod_name)]))
-        result['log'] = '/'.join(mod_name)
+        result['message'] = 'module already installed:', str(exists)
+        result['log'] = ','.join(mod_names)
 
     if force_eb and result['changed'] == False:
         result['changed'] = True
         result['message'] = 'no changed seems needed but forcing to run eb'
-
+        to_install = eb_names
+    end_phase('module_check')
 
     #
     # OTHER PARAMETER
@@ -232,34 +552,38 @@ def run_module():
     keep_std = ans_module.params['keep_std']
     use_fetch = ans_module.params['fetch']
 
+    import socket
+    hostname = socket.gethostname().split('.')[0]
+    build_candidates = ans_module.params['buildpath_candidates']
     if not buildpath: #and softpath:
-        import socket
-        hostname = socket.gethostname() 
-        softhome = os.path.expanduser('~soft')
-        buildpath = os.path.join(softhome,'build', hostname.split('.')[0])    
-        if not os.path.exists(buildpath):
-            if not os.path.exists(os.path.join(softhome, 'build')):
-                os.mkdir(os.path.join(softhome, 'build'))
-            os.mkdir(buildpath)
+        #
+        # fastest directory (first candidate) with enough space for the build
+        #
+        build_size = ans_module.params['build_size'] or estimate_build_size(to_install, instpath)
+        buildpath = choose_buildpath(build_candidates, build_size, hostname, create=not ans_module.check_mode)
+        result['buildpath'] = buildpath
     
     use_cluster = ans_module.params['use_cluster']
     if use_cluster:
         #
         # use the constraint of slurm to get the name
         #
-        import socket
-        hostname = socket.gethostname().split('.')[0]
-        command = ['sinfo', '-o','%n,%f']
-        j = subprocess.Popen(command, stdout=subprocess.PIPE)
-        (stdout, _) = j.communicate()
-        for line in stdout.split('\n'):
-            if hostname in line:
-                feature = line.split(',',1)[1]
-                break
+        if ans_module.check_mode:
+            # no call to sinfo in check mode
+            feature = ans_module.params['slurm_feature']
+        else:
+            hostname, feature = host_slurm_feature(ans_module.params)
+            if not feature:
+                return ans_module.fail_json(msg='no slurm feature found for node %s' % hostname, **result)
+        result['feature'] = feature
+        end_phase('slurm_feature')
         myenv = os.environ.copy()
-        myenv["SBATCH_CONSTRAINT"] = feature
-        myenv["SBATCH_PARTITION"] = "batch,debug"
-        command = ['eb', '--job' , '--job-backend=Slurm', '--job-max-walltime=6']
+        if ans_module.params['job_backend'] == 'easybuild':
+            myenv["SBATCH_CONSTRAINT"] = feature
+            command = ['eb', '--job' , '--job-backend=Slurm']
+        else:
+            # the jobs are submitted by the module (submit_slurm_jobs)
+            command = ['eb']
     else:
         myenv = os.environ
         command = ['eb']
@@ -267,112 +591,479 @@ def run_module():
     #
     # Build the easybuild command
     #    
-    command.append(eb_name)
+    options = []
     if robot:
-        command.append('--robot=%s/../sources/eb_files:%s/../sources/eb_files' % (modpath, modpath.replace('/sw/','/cecisw/')))
-        command.append('--robot-path=%s/../sources/eb_files:%s/../sources/eb_files:/usr/easybuild/easyconfigs' % (modpath, modpath.replace('/sw/','/cecisw/')))
+        options += eb_robot_options(modpath)
     if modpath:
-        command.append('--installpath-modules=%s' % modpath)
+        options.append('--installpath-modules=%s' % modpath)
     if softpath:
-        command.append('--installpath-software=%s' % softpath)
+        options.append('--installpath-software=%s' % softpath)
     if instpath:
-        command.append('--sourcepath=%s' % instpath)
+        options.append('--sourcepath=%s' % instpath)
     if buildpath:
-        command.append('--buildpath=%s' % buildpath)
-    if fetch:
-        command.append('--fetch')
+        options.append('--buildpath=%s' % buildpath)
+    if use_fetch:
+        options.append('--fetch')
     if otherargs:
-        command += otherargs.split()
-
+        options += otherargs.split()
+    # the dependency graph (easyconfig_graph) is built from the untweaked easyconfigs and every
+    # easyconfig is built separately: the --try-* options would be applied to all the dependencies
+    graph_modes = []
+    if ans_module.params['local_parallel'] and not use_cluster:
+        graph_modes.append('local_parallel')
+    if ans_module.params['hierarchical_modules']:
+        graph_modes.append('hierarchical_modules')
+    if use_cluster and ans_module.params['job_backend'] == 'sbatch':
+        graph_modes.append('job_backend=sbatch')
+    if graph_modes and any(opt.startswith('--try-') for opt in options):
+        return ans_module.fail_json(msg='%s can not be combined with --try-* options (search_eb or additional_options)'
+                                    % '/'.join(graph_modes), **result)
+    if use_cluster and ans_module.params['job_backend'] == 'easybuild':
+        #
+        # walltime of the jobs (the same for all of them) from the history of the build times
+        #
+        plan = install_plan(to_install, options, paths.split(':'), ans_module.params, feature)
+        walltime = max([job_walltime(entry['estimated_time'] if entry['history'] else None, ans_module.params)
+                        for entry in plan] or [ans_module.params['job_walltime']])
+        myenv["SBATCH_PARTITION"], walltime = choose_partition(walltime, ans_module.params)
+        import math
+        command.append('--job-max-walltime=%d' % int(math.ceil(walltime)))
+        result['partition'] = myenv["SBATCH_PARTITION"]
+    eb_command = command
+    command = eb_command + to_install + options
 
     #
     # store the eb command for debugging/documentation 
     # 
     result['eb_command'] = ' '.join(command)
 
+    #
+    # for a list of package, compute the missing set over the full dependency graph
+    # (one dry-run for all the packages)
+    #
+    if packages and to_install and not ans_module.check_mode:
+        dry_run = eb_dry_run(to_install, options, myenv)
+        result['missing'] = [entry['module'] for entry in dry_run if not entry['installed']]
+        if not result['missing'] and not force_eb:
+            result['changed'] = False
+            result['message'] = 'all dependencies already installed'
+        end_phase('dry_run')
+
 
     # if the user is working with this module in only check mode we do not
-    # want to make any changes. So return here
+    # want to make any changes. So return here (with the plan of the installation)
     if ans_module.check_mode:
-        result['changed']=False
-        print result
-        ans_module.exit_json(**result)
-        return result
+        if to_install:
+            result['plan'] = install_plan(to_install, options, paths.split(':'), ans_module.params,
+                                          result.get('feature', ''))
+            result['missing'] = [entry['module'] for entry in result['plan']]
+            result['estimated_time'] = sum(entry['estimated_time'] for entry in result['plan'])
+            end_phase('plan')
+        return ans_module.exit_json(**result)
     elif result['changed'] == False:
+        if ans_module.params['hierarchical_modules'] and \
+                not hierarchical_installed(eb_names, options, ans_module.params):
+            # the flat modules exist but a previous generation of the hierarchical ones may have failed
+            log_dir = ans_module.params['log_dir'] or os.path.join(ans_module.params['cache_dir'], 'logs')
+            result['hierarchical'] = hierarchical_pass(eb_names, options, myenv, log_dir, ans_module.params)
+            end_phase('hierarchical')
+            failed = [build for build in result['hierarchical'] if build['state'] != 'ok']
+            if failed:
+                ans_module.fail_json(msg='generation of the hierarchical module %s failed, see %s' %
+                                     (failed[0]['module'], failed[0]['log_file']), **result)
+            if result['hierarchical']:
+                result['changed'] = True
+                result['modules_dir'] = touched_module_dirs(modpath, _trace['start'], ans_module.params)
         return ans_module.exit_json(**result)
+
+    #
+    # lock the modules to install: a concurrent runner (other host or fork) installing the same
+    # module holds a lease in installpath_modules/.locks, wait for its result instead of building again
+    #
+    if ans_module.params['lock_lease']:
+        leases = []
+        ans_module.exit_json = with_lease(ans_module.exit_json, leases, False)
+        ans_module.fail_json = with_lease(ans_module.fail_json, leases, True)
+        for mod_name in sorted(install_modules[eb] for eb in to_install):
+            path = lease_file(modpath, mod_name)
+            start = time.time()
+            token = acquire_lease(path, ans_module.params['lock_lease'], ans_module.params['lock_wait'])
+            if not token:
+                return ans_module.fail_json(msg='timeout waiting for the lock on %s (held by %s)' %
+                                            (mod_name, read_lease(path).get('host')), **result)
+            leases.append((path, token))
+            outcome = read_lease(path + '.result')
+            done = outcome.get('time', 0) > start
+            if done:
+                result.setdefault('waited_for', {})[mod_name] = outcome['host']
+                if outcome['failed']:
+                    return ans_module.fail_json(msg='installation of %s failed on %s: %s' %
+                                                (mod_name, outcome['host'], outcome['msg']), **result)
+            # the time of the result comes from the clock of the other host: look at the module itself too
+            if done or (not force_eb and module_exists(mod_name, [modpath + '/all'])):
+                to_install = [eb for eb in to_install if install_modules[eb] != mod_name]
+        end_phase('lock')
+        if not to_install:
+            result['changed'] = False
+            result['message'] = 'module installed by a concurrent run'
+            return ans_module.exit_json(**result)
+        command = eb_command + to_install + options
+        result['eb_command'] = ' '.join(command)
    
     #
     # run easybuild
     #
    
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=myenv)
-
-        
-    stdout = p.stdout.read()
-    stderr = p.stderr.read()
-    result['returncode'] = str(p.returncode)
-    # do not keep stdout/stderr if no error occur
-
-    if p.returncode or stderr:
-        result['stdout'] = stdout
-        result['stderr'] = stderr
-        #result['returncode'] = p.returncode
-        ans_module.fail_json(msg='eb program failed with returncode %s' % p.returncode, **result)
-    elif keep_std:
-        result['stdout'] = stdout
-        result['stderr'] = stderr
-
-    if use_cluster:
-        while 1:
-            time.sleep(60)
-            username = os.environ.get('USER')
-            command = ['squeue', '-u %s' % username,  '-t PENDING', '-o \"%j %f\"']
-            p = subprocess.Popen(' '.join(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=myenv, shell=True)
-            stdout = p.stdout.read()
-            prog_name = os.path.basename(eb_name).split('.')[0]
-            check_feature = feature.replace(',', '&')
-            for line in stdout.split('\n'):
-                if check_feature in line and prog_name in line:
-                    break
-            else:
-                break
-        
+    #
+    # restore what is available in the artifact store
+    #
+    artifact_store = ans_module.params['artifact_store']
+    artifacts = []
+    if artifact_store and softpath and not any(opt.startswith('--try-') for opt in options):
+        # only the modules missing before the build are restored/published (not the whole stack)
+        for eb in to_install:
+            artifacts += [entry for entry in cached_eb_dry_run(eb, options, ans_module.params)
+                          if entry not in artifacts and not module_file(modpath, entry['module'])]
+        result['restored'] = restore_artifacts(artifacts, artifact_store, modpath, softpath,
+                                               result.get('feature', ''))
+        to_install = [eb for eb in to_install if install_modules[eb] not in result['restored']]
+        if not to_install:
+            result['message'] = 'restored from the artifact store'
+            result['modules_dir'] = touched_module_dirs(modpath, _trace['start'], ans_module.params)
+            return ans_module.exit_json(**result)
+        command = eb_command + to_install + options
+        result['eb_command'] = ' '.join(command)
+        end_phase('artifact_restore')
 
     #
-    # run for the hierachical scheme
+    # download the sources of the missing easyconfigs (build jobs do not need network access)
     #
-    if False:
-        for i,entry in enumerate(command):
-            if entry.startswith('--installpath-modules='):
-                command[i] += '_hierarchical'
-                break
-            else:
-                raise Exception, 'modulepath is mandatory'
-                
-        command.append('--skip')
-        command.append('--rebuild')
-        if '--package' in command:
-            command.remove('--package')
-
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=myenv)
-        stdout = p.stdout.read()
-        stderr = p.stderr.read()
-        result['returncode'] = str(p.returncode)
+    if ans_module.params['prefetch'] and instpath:
+        # with --try-*, the tweaked easyconfigs listed by eb -Dr (outside of the robot path) are removed
+        # when eb exits: their sources are fetched by the build itself
+        robot_paths = [os.path.normpath(path) for path in eb_robot_paths(modpath)]
+        try_options = any(opt.startswith('--try-') for opt in options)
+        entries = []
+        for eb in to_install:
+            entries += [entry for entry in cached_eb_dry_run(eb, options, ans_module.params)
+                        if entry not in entries and not module_exists(entry['module'], [modpath + '/all'])
+                        and not (try_options and not any(os.path.normpath(entry['path']).startswith(path + os.sep)
+                                                         for path in robot_paths))]
+        setup_easybuild(options)
+        result['prefetch'] = prefetch_sources([entry['path'] for entry in entries], instpath,
+                                              ans_module.params['source_mirror'],
+                                              ans_module.params['prefetch_workers'])
+        failed = [source for source in result['prefetch'] if source['status'] == 'failed']
+        if failed:
+            ans_module.fail_json(msg='fail to get %s: %s' % (failed[0]['file'], failed[0]['error']), **result)
+        end_phase('prefetch')
+
+    log_dir = ans_module.params['log_dir'] or os.path.join(ans_module.params['cache_dir'], 'logs')
+    if ans_module.params['local_parallel'] and not use_cluster:
+        #
+        # schedule the build of each missing easyconfig on the local node
+        #
+        nodes = easyconfig_graph(to_install, options)
+        result['builds'] = run_local_parallel(nodes, options, myenv, log_dir, ans_module.params)
+        end_phase('build')
+        record_build_times(ans_module.params, [(build['spec'], '', build['duration'])
+                                               for build in result['builds'] if build['state'] == 'ok'])
+        if ans_module.params['build_purge_age']:
+            result['purged'] = purge_build_trees(build_candidates, hostname, ans_module.params['build_purge_age'])
+        failed = [build for build in result['builds'] if build['state'] != 'ok']
+        if failed:
+            result['returncode'] = str(failed[0]['returncode'])
+            ans_module.fail_json(msg='build of %s failed, see %s' % (failed[0]['module'], failed[0]['log_file']),
+                                 **result)
+        if ans_module.params['hierarchical_modules']:
+            result['hierarchical'] = hierarchical_pass(eb_names, options, myenv, log_dir, ans_module.params)
+            end_phase('hierarchical')
+            failed = [build for build in result['hierarchical'] if build['state'] != 'ok']
+            if failed:
+                ans_module.fail_json(msg='generation of the hierarchical module %s failed, see %s' %
+                                     (failed[0]['module'], failed[0]['log_file']), **result)
+        if artifacts:
+            result['published'] = publish_artifacts(artifacts, artifact_store, modpath, softpath,
+                                                    result.get('feature', ''))
+            end_phase('artifact_publish')
+        result['modules_dir'] = touched_module_dirs(modpath, _trace['start'], ans_module.params)
+        ans_module.exit_json(**result)
+
+    if use_cluster and ans_module.params['job_backend'] == 'sbatch':
+        #
+        # one slurm job per missing easyconfig of the dependency graph, all submitted at once
+        #
+        nodes = easyconfig_graph(to_install, options)
+        jobs = submit_slurm_jobs(nodes, options, myenv, log_dir, feature, ans_module.params)
+        specs = dict((node['module'], node['spec']) for node in nodes)
+        job_easyconfigs = dict((jobid, specs[module]) for jobid, module in jobs.items())
+        end_phase('build')
+    else:
+        result['log_file'] = new_log_file(log_dir, to_install[0])
+        returncode, stdout, stderr = run_command(command, myenv, result['log_file'],
+                                                 ans_module.params['std_tail_lines'])
+        result['returncode'] = str(returncode)
+        end_phase('build')
+        if ans_module.params['build_purge_age']:
+            result['purged'] = purge_build_trees(build_candidates, hostname, ans_module.params['build_purge_age'])
         # do not keep stdout/stderr if no error occur
 
-        if p.returncode or stderr:
-            result['stdout'] += stdout
-            result['stderr'] += stderr
-            #result['returncode'] = p.returncode
-            ans_module.fail_json(msg='eb program failed with returncode %s' % p.returncode, **result)
+        if returncode or stderr:
+            result['stdout'] = stdout
+            result['stderr'] = stderr
+            #result['returncode'] = returncode
+            ans_module.fail_json(msg='eb program failed with returncode %s' % returncode, **result)
         elif keep_std:
-            result['stdout'] += stdout
-            result['stderr'] += stderr
-
+            result['stdout'] = stdout
+            result['stderr'] = stderr
+        if use_cluster:
+            jobs = parse_submitted_jobs(open(result['log_file']).read())
+            job_easyconfigs = dict((jobid, name + '.eb') for jobid, name in jobs.items())
 
+    if use_cluster:
+        #
+        # wait for the submitted jobs
+        #
+        states, failed = wait_slurm_jobs(jobs, myenv, ans_module.params['job_poll_min'],
+                                         ans_module.params['job_poll_max'])
+        result['jobs'] = dict((jobid, dict(name=name, state=states.get(jobid, 'UNKNOWN')))
+                              for jobid, name in jobs.items())
+        end_phase('job_wait')
+        completed = [jobid for jobid in sorted(jobs) if states.get(jobid) == 'COMPLETED']
+        record_build_times(ans_module.params, [(job_easyconfigs[jobid], feature, seconds) for jobid, seconds in
+                                               slurm_job_elapsed(completed, myenv).items()])
+        if failed:
+            jobid = failed[0]
+            result['job_log'] = slurm_job_log(jobid, myenv)
+            ans_module.fail_json(msg='job %s (%s) ended with state %s, see %s' % 
+                                 (jobid, jobs[jobid], states[jobid], result['job_log']), **result)
+        # the jobs are COMPLETED, check that they did install the modules
+        if default_naming_scheme(otherargs):
+            missing = [install_modules[eb] for eb in to_install
+                       if not module_exists(install_modules[eb], [modpath + '/all'])]
+            if missing:
+                ans_module.fail_json(msg='jobs completed but module not installed: %s' % ','.join(missing),
+                                     **result)
 
+    #
+    # module files of the hierarchical scheme (for the software installed in the flat tree)
+    #
+    if ans_module.params['hierarchical_modules']:
+        result['hierarchical'] = hierarchical_pass(eb_names, options, myenv, log_dir, ans_module.params)
+        end_phase('hierarchical')
+        failed = [build for build in result['hierarchical'] if build['state'] != 'ok']
+        if failed:
+            ans_module.fail_json(msg='generation of the hierarchical module %s failed, see %s' %
+                                 (failed[0]['module'], failed[0]['log_file']), **result)
+
+    if artifacts:
+        result['published'] = publish_artifacts(artifacts, artifact_store, modpath, softpath,
+                                                result.get('feature', ''))
+        end_phase('artifact_publish')
+
+    result['modules_dir'] = touched_module_dirs(modpath, _trace['start'], ans_module.params)
     ans_module.exit_json(**result)
 
+#
+# Catalog of the easyconfig files available in the robot path.
+# This replaces the (slow) call to 'eb -S' done for each search.
+#
+_eb_catalog = {}
+
+def eb_robot_paths(modpath):
+    """return the list of directories where eb looks for easyconfig files"""
+    return ['%s/../sources/eb_files' % modpath,
+            '%s/../sources/eb_files' % modpath.replace('/sw/', '/cecisw/'),
+            '/usr/easybuild/easyconfigs']
+
+def eb_robot_options(modpath):
+    """return the --robot/--robot-path options to pass to eb"""
+    paths = eb_robot_paths(modpath)
+    return ['--robot=%s' % ':'.join(paths[:2]),
+            '--robot-path=%s' % ':'.join(paths)]
+
+def clean_eb_name(eb_name, robot):
+    """return the name to give to eb for a package given as input"""
+    if (eb_name.startswith('./') or eb_name.count('/') > 1) and \
+            eb_name.endswith('.eb') and \
+            not os.path.exists(eb_name):
+        # the file should have been moved to the eb_repo which is in the robot path
+        if robot:
+            eb_name = eb_name.rsplit('/',1)[1]
+    return eb_name
+
+def eb_to_module_name(eb_name, strict=True):
+    """return the module name associated to an easyconfig for the default module naming 
+       scheme (EasyBuildMNS: name/version-toolchain-toolchain_version+versionsuffix).
+       if the easyconfig name does not follow the standard convention, return None 
+       (or if strict is False, replace the first "-" by a "/" and remove .eb)
+    """
+    info = parse_eb_name(eb_name)
+    if info:
+        mod_name = '%(name)s/%(version)s' % info
+        if info['toolchain']:
+            mod_name += '-%(toolchain)s-%(toolchain_version)s' % info
+        return mod_name + info['versionsuffix']
+    elif strict:
+        return None
+
+    if eb_name.endswith('.eb'):
+        mod_name = eb_name[:-3]
+    else:
+        mod_name = eb_name
+    if '/' in mod_name:
+        mod_name = mod_name.rsplit('/',1)[1]
+    return '/'.join(mod_name.split("-",1))
+
+def default_naming_scheme(otherargs):
+    """check that eb uses the default module naming scheme (EasyBuildMNS)"""
+    mns = os.environ.get('EASYBUILD_MODULE_NAMING_SCHEME', '')
+    for opt in otherargs.split():
+        if opt.startswith('--module-naming-scheme='):
+            mns = opt.split('=', 1)[1]
+    return mns in ('', 'EasyBuildMNS')
+
+def module_exists(mod_name, mod_paths):
+    """check if the module file (Tcl or Lua) of mod_name is present in one of the mod_paths
+       (without starting the module tool)
+    """
+    for path in mod_paths:
+        if not path:
+            continue
+        modfile = os.path.join(path, mod_name)
+        if os.path.isfile(modfile) or os.path.isfile(modfile + '.lua'):
+            return True
+    return False
+
+def parse_eb_name(filename):
+    """split an easyconfig filename following the standard convention
+          name-version[-toolchain-toolchain_version][versionsuffix].eb
+       into a dictionary with those fields.
+       The version is the first field starting with a digit (the name can contain '-').
+       return None if the filename does not follow the convention.
+    """
+    base = os.path.basename(filename)
+    if base.endswith('.eb'):
+        base = base[:-3]
+    split = base.split('-')
+    for i in range(1, len(split)):
+        if split[i][:1].isdigit():
+            break
+    else:
+        return None
+
+    info = {'name': '-'.join(split[:i]),
+            'version': split[i],
+            'toolchain': '',
+            'toolchain_version': '',
+            'versionsuffix': ''}
+    rest = split[i+1:]
+    if len(rest) > 1 and rest[0] and not rest[0][0].isdigit() and rest[1][:1].isdigit():
+        info['toolchain'], info['toolchain_version'] = rest[:2]
+        rest = rest[2:]
+    if rest:
+        info['versionsuffix'] = '-' + '-'.join(rest)
+    return info
+
+def scan_robot_path(root, cache_dir):
+    """return the list of easyconfigs present in root (recursively).
+       Each entry is a dictionary with the field of parse_eb_name, the filename ('file')
+       and the directory where it is ('dir').
+       The content of each directory is kept on disk and only listed again if the
+       mtime of the directory changed.
+    """
+    import hashlib
+    cache_dir = os.path.expanduser(cache_dir)
+    cache_file = os.path.join(cache_dir, 'eb_catalog_%s.json' % hashlib.sha1(root).hexdigest()[:16])
+    try:
+        old = json.load(open(cache_file))
+    except (IOError, ValueError):
+        old = {}
+
+    new = {}
+    entries = []
+    to_scan = [root]
+    while to_scan:
+        dirpath = to_scan.pop()
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            continue
+        if dirpath in old and old[dirpath][0] == mtime:
+            new[dirpath] = old[dirpath]
+        else:
+            subdirs, ebs = [], []
+            for name in os.listdir(dirpath):
+                if name.endswith('.eb'):
+                    info = parse_eb_name(name)
+                    if info:
+                        info['file'] = name
+                        info['dir'] = dirpath
+                        ebs.append(info)
+                elif not name.startswith('.') and os.path.isdir(os.path.join(dirpath, name)):
+                    subdirs.append(name)
+            new[dirpath] = [mtime, subdirs, ebs]
+        to_scan += [os.path.join(dirpath, d) for d in new[dirpath][1]]
+        entries += new[dirpath][2]
+
+    if new != old:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            json.dump(new, open(cache_file + '.tmp', 'w'))
+            os.rename(cache_file + '.tmp', cache_file)
+        except (IOError, OSError):
+            pass # the catalog is only a cache
+    return entries
+
+def load_eb_catalog(mod_opts):
+    """return the catalog of the easyconfig available in the robot path.
+       This is a list (one per robot path [CFGS1, CFGS2,...]) of list of easyconfig entries.
+    """
+    if mod_opts['robot']:
+        roots = eb_robot_paths(mod_opts['installpath_modules'])
+    else:
+        roots = eb_robot_paths(mod_opts['installpath_modules'])[-1:]
+    key = tuple(roots)
+    if key not in _eb_catalog:
+        _eb_catalog[key] = [scan_robot_path(root, mod_opts['cache_dir']) for root in roots]
+    return _eb_catalog[key]
+
+def catalog_find(eb_name, mod_opts):
+    """return the path of the easyconfig eb_name in the robot path (None if not found)"""
+    eb_name = os.path.basename(eb_name)
+    for entries in load_eb_catalog(mod_opts):
+        for entry in entries:
+            if entry['file'] == eb_name:
+                return os.path.join(entry['dir'], entry['file'])
+    return None
+
+def version_key(version):
+    """key to sort software/toolchain versions ('1.10' > '1.9', '2017b' > '2017a')"""
+    return [(1, int(part)) if part.isdigit() else (0, part)
+            for part in re.findall(r'\d+|[a-zA-Z]+', version)]
+
+def eb_file_name(info):
+    """return the easyconfig filename associated to the fields of parse_eb_name"""
+    name = '%(name)s-%(version)s' % info
+    if info['toolchain']:
+        name += '-%(toolchain)s-%(toolchain_version)s' % info
+    return name + info['versionsuffix'] + '.eb'
+
+def split_toolchain_version(entry, toolchain_version):
+    """return the toolchain version and the versionsuffix of a catalog entry.
+       parse_eb_name stops the toolchain version at the first '-': for a requested toolchain 
+       version with '-' (GCC,6.3.0-2.27), the same number of leading parts of the versionsuffix 
+       starting with a digit belong to the toolchain version (GCC-6.4.0-2.28).
+    """
+    tc_version = entry['toolchain_version']
+    parts = entry['versionsuffix'].split('-')[1:]
+    for _ in range(toolchain_version.count('-')):
+        if not parts or not parts[0][:1].isdigit():
+            break
+        tc_version += '-' + parts.pop(0)
+    return tc_version, ''.join('-' + part for part in parts)
+
 def search_eb_module(program, toolchain, version, mod_opts):
     """find an easyblock for the associate program with the specified tool_chain [in format name,version]
        for the associate version (if specified). 
@@ -384,52 +1075,16 @@ def search_eb_module(program, toolchain, version, mod_opts):
           2) the name of the eb that we would have to check to see if it is already installed
           3) the additional options to pass to eb to install such package
   
-       Note if more that one version is available for such program/tool_chain, it returns 
-         1) the one in the sources directory if exists
-         2) the latest one of those.
+       All the easyconfigs of the program (from the catalog) are ranked in one pass:
+         1) exact match of the version/toolchain
+         2) (if strict_version is False) same toolchain name (any version), 
+            the ones with the requested software version first.
+         3) (if strict_version is False) any toolchain, the ones with the requested software version first.
+       Within a level, the one in the sources directory are preferred, then the ones without 
+       versionsuffix and then the highest software version and toolchain version.
     """
 
     strict_version = mod_opts['strict_search']
-    robot = mod_opts['robot']
-    mod_opts = mod_opts
-
-    # usefull function to return the valid eb module from a 
-    def eb_search(pattern, mod_opts):
-
-        results = {}
-        only_keep = None # if some from softhpath only return those
-        cmd = ['eb' , '-S', pattern]
-        if mod_opts['robot']:
-            softpath = mod_opts['installpath_modules']
-            cmd.append('--robot=%s/../sources/eb_files:%s/../sources/eb_files' % (softpath,softpath.replace('/sw/','/cecisw/')))
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        #raise Exception, p.stdout.read() + ' '.join(cmd)
-        all_lines = []
-        for line in p.stdout:
-            all_lines.append(line)
-            line = line.strip()
-            if line.startswith('CFGS'):
-                key, path = line.split("=")
-                results[key] = []
-                if softpath in path:
-                    assert not only_keep
-                    only_keep = key
-                
-            if line.startswith('*'):
-                split = line.split('/')
-                key = split[0].split('$',1)[1].strip()
-                name = split[-1]
-                results[key].append(name)
-
-            if "ERROR: You seem to be running EasyBuild with root privileges which is not wise, so let's end this here." in line:
-                raise Exception, line
-        
-        if only_keep and results[only_keep]:
-            return results[only_keep]
-        else:
-            return [item for sublist in results.values() for item in sublist]
-
-        return results
 
     if ',' in toolchain:
         toolchain_name, toolchain_version = toolchain.split(',')
@@ -437,112 +1092,1160 @@ def search_eb_module(program, toolchain, version, mod_opts):
         toolchain_name, v1, v2 = re.split('(\d*)', toolchain ,1)
         toolchain_version = '%s%s' % (v1, v2)
     else:
-        toolchain_name = '.*'
-        toolchain_version = '.*'
-
-    if version == '':
-        pattern = '^%s-.*-%s-%s' % (program, toolchain_name, toolchain_version)
-        modules = eb_search(pattern, mod_opts)
-        if len(modules)==1:
-            return modules[0], modules[0], []
-        elif len(modules)>1:
-            # need to find the highest version number
-            vers= [LooseVersion(i) for i in modules]
-            mod = str(max(vers))
-            return mod, mod, []
-        elif not strict_version:
-            # no result try be reducing the toolchain version constraint
-            if toolchain_version != '.*':
-                mod1, mod2, args = search_eb_module(program, '%s,.*' % toolchain_name, '', mod_opts)
-                mod2 = mod2.split('-')
-                mod2[3] = toolchain_version
-                mod2 = '-'.join(mod2)
-                #assert not args
-                return mod1, mod2, ['--try-toolchain=%s,%s' % (toolchain_name, toolchain_version)]
-            elif toolchain_name != '.*':
-                mod1, mod2, args = search_eb_module(program, '.*,.*', '', mod_opts)
-                mod2 = mod2.split('-')
-                mod2[3] = toolchain_version
-                mod2[2] = toolchain_name
-                mod2 = '-'.join(mod2)
-                return mod1, mod2, ['--try-toolchain=%s,%s' % (toolchain_name, toolchain_version)]
+        toolchain_name = ''
+        toolchain_version = ''
+
+    candidates = []
+    for cfgs, entries in enumerate(load_eb_catalog(mod_opts)):
+        for entry in entries:
+            if entry['name'].lower() != program.lower():
+                continue
+            tc_version, suffix = split_toolchain_version(entry, toolchain_version)
+            same_version = not version or entry['version'] == version
+            same_tc_name = not toolchain_name or entry['toolchain'] == toolchain_name
+            same_tc = same_tc_name and (not toolchain_version or tc_version == toolchain_version)
+            if same_version and same_tc:
+                level = 0
+            elif strict_version:
+                continue
+            elif same_tc_name:
+                level = 1
             else:
-                return None, None, []
+                level = 2
+            # only the first robot path is the sources directory of installpath_modules
+            in_sources = mod_opts['robot'] and cfgs == 0
+            key = (-level, in_sources, same_version, not suffix, version_key(entry['version']),
+                   version_key(tc_version), version_key(suffix))
+            candidates.append((key, dict(entry, toolchain_version=tc_version, versionsuffix=suffix)))
+
+    if not candidates:
+        return None, None, []
+
+    best = max(candidates, key=lambda candidate: candidate[0])[1]
+    target = dict(best)
+    options = []
+    if version and best['version'] != version:
+        target['version'] = version
+        options.append('--try-software-version=%s' % version)
+    if toolchain_name and (best['toolchain'], best['toolchain_version']) != (toolchain_name, toolchain_version):
+        target['toolchain'] = toolchain_name
+        target['toolchain_version'] = toolchain_version or best['toolchain_version']
+        options.append('--try-toolchain=%s,%s' % (target['toolchain'], target['toolchain_version']))
+
+    return best['file'], eb_file_name(target), options
+
+def search_eb_modules(search_list, mod_opts):
+    """resolve a list of {package:, version:, toolchain:} with search_eb_module.
+       All the searches share the same catalog (so the robot path is scanned only once).
+       return the list of dictionary (eb_name, eb_name_for_search, options) associated to each entry
+       (ValueError if an entry is not valid)
+    """
+    resolved = []
+    for entry in search_list:
+        if not isinstance(entry, dict) or not entry.get('package'):
+            raise ValueError('invalid entry in search_list (expected {package:, version:, toolchain:}): %s'
+                             % entry)
+        program = entry['package']
+        version = entry.get('version', '') or ''
+        toolchain = entry.get('toolchain', '') or ''
+        eb_name, eb_name_for_search, options = search_eb_module(program, toolchain, version, mod_opts)
+        resolved.append(dict(package=program, version=version, toolchain=toolchain,
+                             eb_name=eb_name, eb_name_for_search=eb_name_for_search,
+                             options=options))
+    return resolved
+
+def run_capture(cmd, env=None):
+    """run cmd and return its returncode and output (stdout and stderr merged)"""
+    start = time.time()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    (stdout, _) = p.communicate()
+    record_command(cmd, start, p.returncode)
+    return p.returncode, stdout
+
+def new_log_file(log_dir, eb_name):
+    """return the path of a new log file for the eb run of eb_name"""
+    log_dir = os.path.expanduser(log_dir)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    name = os.path.basename(eb_name)
+    if name.endswith('.eb'):
+        name = name[:-3]
+    return os.path.join(log_dir, '%s-%s-%s.log' % (name, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+def run_command(cmd, env, log_file, tail_lines=500):
+    """run cmd and write its stdout/stderr in log_file (lines of stderr are prefixed by 'stderr: ').
+       Both streams are read concurrently and only the last tail_lines lines of each 
+       are kept in memory.
+       return the returncode, the end of the stdout and the end of the stderr
+    """
+    import threading
+    from collections import deque
+
+    start = time.time()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    log = open(log_file, 'w')
+    log.write('# %s\n' % ' '.join(cmd))
+    lock = threading.Lock()
+    tails = {'stdout': deque(maxlen=tail_lines), 'stderr': deque(maxlen=tail_lines)}
+
+    def read_stream(stream, tail, prefix):
+        for line in iter(stream.readline, ''):
+            tail.append(line)
+            with lock:
+                log.write(prefix + line)
+        stream.close()
+
+    readers = [threading.Thread(target=read_stream, args=(p.stdout, tails['stdout'], '')),
+               threading.Thread(target=read_stream, args=(p.stderr, tails['stderr'], 'stderr: '))]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    returncode = p.wait()
+    log.close()
+    record_command(cmd, start, returncode)
+    return returncode, ''.join(tails['stdout']), ''.join(tails['stderr'])
+
+def slurm_node_features(cache_dir, ttl=3600):
+    """return the map node -> feature of the cluster (from 'sinfo').
+       The map is kept in cache_dir and only refreshed if older than ttl seconds.
+    """
+    cache_file = os.path.join(os.path.expanduser(cache_dir), 'slurm_features.json')
+    try:
+        if time.time() - os.stat(cache_file).st_mtime < ttl:
+            return json.load(open(cache_file))
+    except (OSError, IOError, ValueError):
+        pass
+
+    returncode, stdout = run_capture(['sinfo', '-h', '-N', '-o', '%n|%f'])
+    if returncode:
+        raise Exception('sinfo failed:\n' + stdout)
+    features = {}
+    for line in stdout.split('\n'):
+        if '|' in line:
+            node, feature = line.strip().split('|', 1)
+            features[node.split('.')[0]] = feature
+
+    try:
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        json.dump(features, open(cache_file + '.tmp', 'w'))
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        pass
+    return features
+
+def host_slurm_feature(params):
+    """return the short hostname and its slurm feature (slurm_feature or from sinfo, None if not found)"""
+    import socket
+    hostname = socket.gethostname().split('.')[0]
+    feature = params['slurm_feature']
+    if not feature:
+        feature = slurm_node_features(params['cache_dir'], params['feature_cache_ttl']).get(hostname)
+    return hostname, feature
+
+#
+# download of the sources
+#
+def easyconfig_sources(ec_path):
+    """return the sources of an easyconfig as a list of dictionary with
+          - filename: name of the file in the sourcepath
+          - download_filename: name of the file to download
+          - urls: the urls where the file can be downloaded
+          - checksum: (type, value) or None
+          - subdir: directory of the file in the sourcepath (<first letter>/<name>)
+       (easybuild needs to be configured)
+    """
+    from easybuild.framework.easyconfig.easyconfig import process_easyconfig
+
+    sources = []
+    for spec in process_easyconfig(ec_path):
+        ec = spec['ec']
+        checksums = ec['checksums'] or []
+        subdir = os.path.join(ec['name'][0].lower(), ec['name'])
+        for i, source in enumerate(ec['sources']):
+            if isinstance(source, dict):
+                filename = source['filename']
+                download_filename = source.get('download_filename', filename)
+                urls = source.get('source_urls', ec['source_urls'])
+            else:
+                filename = download_filename = source
+                urls = ec['source_urls']
+            checksum = checksums[i] if i < len(checksums) else None
+            if isinstance(checksum, basestring):
+                checksum = ('md5' if len(checksum) == 32 else 'sha256', checksum)
+            elif not (isinstance(checksum, (tuple, list)) and len(checksum) == 2 and
+                      isinstance(checksum[1], basestring)):
+                checksum = None
+            sources.append(dict(filename=filename, download_filename=download_filename,
+                                urls=list(urls), checksum=checksum, subdir=subdir))
+    return sources
+
+def fetch_source(source, sourcepath, mirror):
+    """download (if needed) and verify a source (see easyconfig_sources) in sourcepath
+       return a dictionary with the file, its status (present/downloaded/failed) and an error message
+    """
+    import hashlib
+    import shutil
+    import urllib2
+
+    target = os.path.join(sourcepath, source['subdir'], source['filename'])
+    status = 'present'
+    error = ''
+    if not os.path.exists(target):
+        status = 'failed'
+        urls = []
+        if mirror:
+            if '://' not in mirror:
+                mirror = 'file://' + os.path.abspath(mirror)
+            urls += ['%s/%s/%s' % (mirror.rstrip('/'), source['subdir'], source['filename']),
+                     '%s/%s' % (mirror.rstrip('/'), source['filename'])]
+        urls += ['%s/%s' % (url.rstrip('/'), source['download_filename']) for url in source['urls']]
+        if not os.path.exists(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                pass # created by another thread
+        tmp = '%s.%s.part' % (target, os.getpid())
+        for url in urls:
+            try:
+                remote = urllib2.urlopen(url, timeout=60)
+                shutil.copyfileobj(remote, open(tmp, 'wb'))
+                os.rename(tmp, target)
+                status = 'downloaded'
+                break
+            except (IOError, OSError, urllib2.URLError) as err:
+                error = '%s: %s' % (url, err)
         else:
-            return None, None, []
-
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return dict(file=target, status=status, error=error or 'no url to download the file')
+
+    if source['checksum']:
+        algo, value = source['checksum']
+        try:
+            checksum = hashlib.new(algo)
+        except ValueError:
+            return dict(file=target, status=status, error='unsupported checksum type %s' % algo)
+        handle = open(target, 'rb')
+        for block in iter(lambda: handle.read(1 << 20), ''):
+            checksum.update(block)
+        handle.close()
+        if checksum.hexdigest() != value:
+            if status == 'downloaded':
+                os.remove(target)
+            return dict(file=target, status='failed', error='%s checksum mismatch' % algo)
+    return dict(file=target, status=status, error='')
+
+def prefetch_sources(ec_paths, sourcepath, mirror='', workers=8):
+    """download the sources of all the easyconfigs in ec_paths concurrently
+       (each file only once even if used by more than one easyconfig) and verify their checksum.
+       return the status of each file (see fetch_source)
+    """
+    from multiprocessing.pool import ThreadPool
+
+    sources = {}
+    for ec_path in ec_paths:
+        for source in easyconfig_sources(ec_path):
+            sources.setdefault(os.path.join(source['subdir'], source['filename']), source)
+    if not sources:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(sources))))
+    try:
+        return pool.map(lambda source: fetch_source(source, sourcepath, mirror),
+                        [sources[key] for key in sorted(sources)])
+    finally:
+        pool.close()
+
+#
+# store of installed software (binary artifact)
+#
+def artifact_file(store, ec_path, module, feature, softpath):
+    """return the path of the artifact for the easyconfig ec_path (installed as module) in store.
+       The key is the checksum of the easyconfig, its toolchain, the slurm feature and 
+       the installation path (the software are not relocatable)
+    """
+    import hashlib
+    info = parse_eb_name(ec_path) or {}
+    toolchain = '%s,%s' % (info.get('toolchain') or 'system', info.get('toolchain_version', ''))
+    checksum = hashlib.sha256(open(ec_path).read()).hexdigest()
+    key = hashlib.sha256('\n'.join([checksum, toolchain, feature, softpath])).hexdigest()[:32]
+    return os.path.join(os.path.expanduser(store), module.split('/')[0], '%s.tar.gz' % key)
+
+def touched_module_dirs(modpath, since, params):
+    """return the module directories (modpath/all/<name>) modified since the given time
+       (and the ones of the hierarchical tree, at any depth), for the refresh of the Lmod spider cache
+    """
+    root = os.path.join(modpath, 'all')
+    dirs = []
+    for name in os.listdir(root) if os.path.isdir(root) else []:
+        try:
+            if os.stat(os.path.join(root, name)).st_mtime >= since:
+                dirs.append(os.path.join(root, name))
+        except OSError:
+            pass
+    if params['hierarchical_modules']:
+        hier_path = hierarchical_path(params)
+        # the modules are written in all/Core/..., all/Compiler/<compiler>/<version>/...
+        for dirpath, _, _ in os.walk(os.path.join(hier_path, 'all')):
+            try:
+                if os.stat(dirpath).st_mtime >= since:
+                    dirs.append(dirpath)
+            except OSError:
+                pass
+    return dirs
+
+def module_file(modpath, module):
+    """return the module file of module in modpath/all (None if not installed)"""
+    modfile = os.path.join(modpath, 'all', module)
+    for path in (modfile, modfile + '.lua'):
+        if os.path.isfile(path):
+            return path
+    return None
+
+def valid_artifact_members(members):
+    """check that the members of an artifact (tarfile) are extracted in the extraction directory:
+       regular files, directories and links only, no absolute path or '..', no member below a 
+       symbolic link and no link pointing outside of the tree (or hard link to a symbolic link)
+    """
+    links = set(os.path.normpath(member.name) for member in members if member.issym())
+    for member in members:
+        name = os.path.normpath(member.name)
+        if member.name.startswith('/') or name == '..' or name.startswith('../'):
+            return False
+        parts = name.split('/')
+        if any('/'.join(parts[:i]) in links for i in range(1, len(parts))):
+            return False
+        if member.issym():
+            target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+        elif member.islnk():
+            target = os.path.normpath(member.linkname)
+            if target in links:
+                return False
+        elif member.isfile() or member.isdir():
+            continue
+        else:
+            return False
+        if member.linkname.startswith('/') or target == '..' or target.startswith('../'):
+            return False
+    return True
+
+def restore_artifacts(entries, store, modpath, softpath, feature):
+    """install the software+module of the entries (from eb_dry_run) not yet installed
+       if they are in the artifact store.
+       return the list of restored modules
+    """
+    import shutil
+    import tarfile
+    import tempfile
+
+    restored = []
+    for entry in entries:
+        tarball = artifact_file(store, entry['path'], entry['module'], feature, softpath)
+        if module_file(modpath, entry['module']) or not os.path.exists(tarball):
+            continue
+        tar = tarfile.open(tarball)
+        if not valid_artifact_members(tar.getmembers()):
+            raise Exception('invalid artifact %s' % tarball)
+        # extract next to the final place and move it
+        staging = tempfile.mkdtemp(prefix='.artifact-', dir=softpath)
+        try:
+            tar.extractall(staging)
+            softdir = os.path.join(softpath, entry['module'])
+            if not os.path.exists(os.path.dirname(softdir)):
+                os.makedirs(os.path.dirname(softdir))
+            if os.path.exists(softdir):
+                shutil.rmtree(softdir)
+            os.rename(os.path.join(staging, 'software', entry['module']), softdir)
+            moddir = os.path.join(staging, 'modules', os.path.dirname(entry['module']))
+            target = os.path.join(modpath, 'all', os.path.dirname(entry['module']))
+            if not os.path.exists(target):
+                os.makedirs(target)
+            for name in os.listdir(moddir):
+                shutil.copy2(os.path.join(moddir, name), target)
+        finally:
+            tar.close()
+            shutil.rmtree(staging)
+        restored.append(entry['module'])
+    return restored
+
+def publish_artifacts(entries, store, modpath, softpath, feature):
+    """add the software+module of the entries (from eb_dry_run) to the artifact store 
+       (if installed and not yet in the store).
+       return the list of published modules
+    """
+    import tarfile
+
+    published = []
+    for entry in entries:
+        modfile = module_file(modpath, entry['module'])
+        softdir = os.path.join(softpath, entry['module'])
+        tarball = artifact_file(store, entry['path'], entry['module'], feature, softpath)
+        if not modfile or not os.path.isdir(softdir) or os.path.exists(tarball):
+            continue
+        if not os.path.exists(os.path.dirname(tarball)):
+            os.makedirs(os.path.dirname(tarball))
+        tmp = '%s.%s.tmp' % (tarball, os.getpid())
+        tar = tarfile.open(tmp, 'w:gz')
+        tar.add(softdir, os.path.join('software', entry['module']))
+        tar.add(modfile, os.path.join('modules', os.path.dirname(entry['module']), os.path.basename(modfile)))
+        tar.close()
+        json.dump(dict(easyconfig=entry['path'], module=entry['module'], feature=feature,
+                       installpath_software=softpath, created=time.time()),
+                  open(tarball[:-len('.tar.gz')] + '.json', 'w'))
+        os.rename(tmp, tarball)
+        published.append(entry['module'])
+    return published
+
+#
+# lease lock on the modules being installed (shared between the hosts through installpath_modules)
+#
+def lease_file(modpath, module):
+    return os.path.join(modpath, '.locks', module.replace('/', '_') + '.lease')
+
+def read_lease(path):
+    """return the content of a lease (or of its .result file), {} if not readable"""
+    try:
+        return json.load(open(path))
+    except (IOError, OSError, ValueError):
+        return {}
+
+def acquire_lease(path, lease=120, wait=0, poll=5):
+    """create the lease file path exclusively and keep it alive (heartbeat every lease/3 seconds).
+       A lease which was not refreshed since lease seconds belongs to a dead runner and is stolen.
+       return a token to give to release_lease (None if not obtained within wait seconds, 0: no limit)
+    """
+    import socket
+    import threading
+    import errno
+
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass # created by another runner
+    token = dict(host=socket.gethostname(), pid=os.getpid(), time=time.time())
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            os.write(fd, json.dumps(token).encode())
+            os.close(fd)
+            break
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.stat(path).st_mtime > lease:
+                # only one runner succeeds to move the expired lease away
+                stale = '%s.stale.%s.%s' % (path, token['host'], token['pid'])
+                os.rename(path, stale)
+                os.remove(stale)
+                continue
+        except OSError:
+            continue # released (or stolen) in the meantime
+        if wait and time.time() - start > wait:
+            return None
+        time.sleep(poll)
+
+    token['stop'] = threading.Event()
+    def heartbeat():
+        while not token['stop'].wait(lease / 3.):
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+    token['thread'] = threading.Thread(target=heartbeat)
+    token['thread'].daemon = True
+    token['thread'].start()
+    return token
+
+def release_lease(path, token, outcome):
+    """stop the heartbeat, write the outcome of the runner (for the waiting runners) and remove the lease"""
+    token['stop'].set()
+    token['thread'].join()
+    outcome = dict(outcome, host=token['host'], time=time.time())
+    json.dump(outcome, open(path + '.result.tmp%s' % token['pid'], 'w'))
+    os.rename(path + '.result.tmp%s' % token['pid'], path + '.result')
+    owner = read_lease(path)
+    if owner.get('host') == token['host'] and owner.get('pid') == token['pid']:
+        os.remove(path)
+
+def with_lease(exit_function, leases, failed):
+    """wrap exit_json/fail_json to release the leases held by the module"""
+    def leased_exit(**result):
+        for path, token in leases:
+            release_lease(path, token, dict(failed=failed, msg=result.get('msg', result.get('message', ''))))
+        del leases[:]
+        return exit_function(**result)
+    return leased_exit
+
+#
+# choice and cleanup of the build directory
+#
+def free_space(path):
+    """return the free space (in GB) of the filesystem of path (or of its first existing parent)"""
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize / 1024.**3
+
+def estimate_build_size(eb_names, sourcepath, factor=10, default=10):
+    """return the estimated size (in GB) of the build of eb_names: factor times the size of their
+       sources found in sourcepath (default if no source is found)
+    """
+    sizes = []
+    for eb_name in eb_names:
+        info = parse_eb_name(os.path.basename(eb_name))
+        if not info or not sourcepath:
+            continue
+        srcdir = os.path.join(sourcepath, info['name'][0].lower(), info['name'])
+        if os.path.isdir(srcdir):
+            size = sum(os.path.getsize(os.path.join(srcdir, filename)) for filename in os.listdir(srcdir)
+                       if info['version'] in filename and os.path.isfile(os.path.join(srcdir, filename)))
+            if size:
+                sizes.append(factor * size / 1024.**3)
+    return max(sizes) if sizes else default
+
+def build_bases(candidates):
+    """return the directories under which the per-host build directories are created"""
+    return [os.path.expanduser(base) for base in candidates] + [os.path.join(os.path.expanduser('~soft'), 'build')]
+
+def choose_buildpath(candidates, size, hostname, create=True):
+    """return the build directory of the host: <candidate>/<hostname> for the first candidate with 
+       at least size GB available (~soft/build/<hostname> if none)
+    """
+    bases = build_bases(candidates)
+    for base in bases:
+        try:
+            if os.path.isdir(base) and os.access(base, os.W_OK) and free_space(base) >= size:
+                break
+        except OSError:
+            continue
     else:
-        pattern = '^%s-%s-%s-%s' % (program, version, toolchain_name, toolchain_version)
-        modules = eb_search(pattern, mod_opts)
-        if len(modules)==1:
-            return modules[0], modules[0], []
-        elif len(modules)>1:
-            # need to find the highest version number
-            vers= [LooseVersion(i) for i in modules]
-            mod = str(max(vers))
-            return mod, mod, []
-        elif not strict_version:
-            # no result try be reducing the toolchain version constraint and the version constraint!
-            # due to the ordering in LooseVersion we will select the code with the highest version first
-            # but try to keep the type of toolchain to starstwith
-            mod1, mod2, args = search_eb_module(program, '%s,.*' % toolchain_name, '', mod_opts)
-            mod2 = mod2.split('-')
-            new_args = []
-            has_new_version = False
-            has_new_tool = False
-            if mod2[1] != version:
-                mod2[1] = version
-                has_new_version = True
-                new_args.append('--try-software-version=%s' % version)
-            if mod2[2] != toolchain_name:
-                mod2[2] = toolchain_name
-                has_new_tool = True
-                new_args.append('--try-toolchain=%s,%s' % (toolchain_name, toolchain_version))
-            if mod2[3] != toolchain_version:
-                mod2[3] = toolchain_version
-                if not has_new_tool:
-                    has_new_tool = True
-                    new_args.append('--try-toolchain=%s,%s' % (toolchain_name, toolchain_version))
-            if not has_new_tool:
-                new_args += args
-            mod2 = '-'.join(mod2)
-            return mod1, mod2, new_args
+        base = bases[-1]
+    buildpath = os.path.join(base, hostname)
+    if create and not os.path.exists(buildpath):
+        os.makedirs(buildpath)
+    return buildpath
+
+def purge_build_trees(candidates, hostname, age):
+    """remove the build trees of the host not modified since age days, return the removed paths"""
+    import shutil
+    removed = []
+    for base in build_bases(candidates):
+        buildpath = os.path.join(base, hostname)
+        if not os.path.isdir(buildpath):
+            continue
+        for name in os.listdir(buildpath):
+            path = os.path.join(buildpath, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > age * 86400:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed.append(path)
+            except OSError:
+                pass
+    return removed
+
+#
+# parallel build on the local node
+#
+def easyconfig_graph(eb_names, options, retain_all=False):
+    """return the missing easyconfigs (all of them if retain_all) in the dependency graph of eb_names 
+       (in installation order). Each entry is a dictionary with
+          - spec: the path of the easyconfig
+          - module: the name of the associated module
+          - deps: the modules of the missing easyconfigs it depends on
+    """
+    setup_easybuild(options)
+    from easybuild.framework.easyconfig.easyconfig import ActiveMNS
+    from easybuild.framework.easyconfig.tools import det_easyconfig_paths, parse_easyconfigs
+    from easybuild.tools.modules import modules_tool
+    from easybuild.tools.robot import resolve_dependencies
+
+    paths = det_easyconfig_paths(list(eb_names))
+    easyconfigs, _ = parse_easyconfigs([(path, False) for path in paths])
+    ordered = resolve_dependencies(easyconfigs, modules_tool(), retain_all_deps=retain_all)
+    missing = set(ec['full_mod_name'] for ec in ordered)
+    mns = ActiveMNS()
+    nodes = []
+    for ec in ordered:
+        deps = [mns.det_full_module_name(dep) for dep in ec['ec'].all_dependencies]
+        nodes.append(dict(spec=ec['spec'], module=ec['full_mod_name'],
+                          deps=[dep for dep in deps if dep in missing]))
+    return nodes
+
+def run_local_parallel(nodes, options, env, log_dir, params):
+    """build the easyconfigs of nodes (see easyconfig_graph) concurrently.
+       An easyconfig is started as soon as all its dependencies are installed and 
+       if enough cores/memory are available (params local_cores, local_memory, job_cores, job_memory).
+       return the list of builds (module, spec, state, returncode, log_file, duration)
+    """
+    import multiprocessing
+    import threading
+    try:
+        from Queue import Queue
+    except ImportError:
+        from queue import Queue
+
+    max_cores = params['local_cores'] or multiprocessing.cpu_count()
+    max_memory = params['local_memory']
+    job_cores = params['job_cores']
+    job_memory = params['job_memory']
+    options = [opt for opt in options if not opt.startswith('--robot=')]
+    for opt in options:
+        if opt.startswith('--parallel='):
+            job_cores = int(opt.split('=', 1)[1])
+    if not any(opt.startswith('--parallel=') for opt in options):
+        options.append('--parallel=%s' % job_cores)
+    job_cores = min(job_cores, max_cores)
+
+    done = Queue()
+    def build(node, log_file):
+        # always report the build, the main loop waits for it
+        start = time.time()
+        returncode = -1
+        try:
+            returncode, _, _ = run_command(['eb', node['spec']] + options, env, log_file,
+                                           params['std_tail_lines'])
+        finally:
+            done.put((node['module'], returncode, time.time() - start))
+
+    builds = dict((node['module'], dict(module=node['module'], spec=node['spec'], state='pending',
+                                        returncode=None, log_file='', duration=0)) for node in nodes)
+    pending = list(nodes)
+    running = 0
+    used_cores = used_memory = 0
+    while pending or running:
+        for node in list(pending):
+            states = [builds[dep]['state'] for dep in node['deps']]
+            if any(state in ('failed', 'skipped') for state in states):
+                builds[node['module']]['state'] = 'skipped'
+                pending.remove(node)
+            elif all(state == 'ok' for state in states):
+                if running and (used_cores + job_cores > max_cores or
+                                (max_memory and used_memory + job_memory > max_memory)):
+                    continue
+                pending.remove(node)
+                builds[node['module']]['state'] = 'running'
+                builds[node['module']]['log_file'] = new_log_file(log_dir, node['spec'])
+                thread = threading.Thread(target=build, args=(node, builds[node['module']]['log_file']))
+                thread.daemon = True
+                thread.start()
+                running += 1
+                used_cores += job_cores
+                used_memory += job_memory
+        if not running:
+            break
+        module, returncode, duration = done.get()
+        builds[module]['duration'] = duration
+        running -= 1
+        used_cores -= job_cores
+        used_memory -= job_memory
+        builds[module]['returncode'] = returncode
+        builds[module]['state'] = 'failed' if returncode else 'ok'
+
+    return [builds[node['module']] for node in nodes]
+
+def hierarchical_options(options, hier_path):
+    """return the eb options to generate the modules of the hierarchical scheme in hier_path.
+       MigrateFromEBToHMNS gives the hierarchical module names but keeps the installation
+       directories of EasyBuildMNS (the software installed by the flat build)
+    """
+    options = [opt for opt in options if not opt.startswith(('--installpath-modules=', '--module-naming-scheme='))
+               and opt not in ('--module-only', '--rebuild', '--force')]
+    return options + ['--installpath-modules=%s' % hier_path, '--module-naming-scheme=MigrateFromEBToHMNS',
+                      '--module-only']
+
+def hierarchical_pass(eb_names, options, env, log_dir, params):
+    """generate (eb --module-only) the modules of the hierarchical scheme (in installpath_hierarchical)
+       which are missing for the dependency graph of eb_names (already installed in the flat tree).
+       The easyconfigs are done concurrently, as soon as the modules of their dependencies exist.
+       return the list of generations (as run_local_parallel)
+    """
+    hier_path = hierarchical_path(params)
+    hier_options = hierarchical_options(options, hier_path)
+    os.environ['MODULEPATH'] = ':'.join([hier_path + '/all'] + [path for path in
+                                        os.environ.get('MODULEPATH', '').split(':') if path])
+    setup_easybuild(hier_options, reconfigure=True)
+    # the hierarchical modules of the whole graph are kept for hierarchical_installed,
+    # the missing ones are the ones not found in the hierarchical tree
+    nodes = easyconfig_graph(eb_names, hier_options, retain_all=True)
+    record = hierarchical_record(eb_names, options, params)
+    if record:
+        try:
+            write_atomic(record, json.dumps([node['module'] for node in nodes]))
+        except (IOError, OSError):
+            pass # only a cache
+    missing = set(node['module'] for node in nodes if not module_exists(node['module'], [hier_path + '/all']))
+    nodes = [dict(node, deps=[dep for dep in node['deps'] if dep in missing])
+             for node in nodes if node['module'] in missing]
+    return run_local_parallel(nodes, hier_options, env, log_dir, dict(params, job_cores=1, job_memory=0))
+
+def hierarchical_path(params):
+    return params['installpath_hierarchical'] or params['installpath_modules'].rstrip('/') + '_hierarchical'
+
+def hierarchical_record(eb_names, options, params):
+    """return the file keeping the hierarchical modules of the dependency graph of eb_names.
+       As for cached_eb_dry_run, the key is the content of the easyconfigs and the robot path/options
+       (None if an easyconfig can not be located)
+    """
+    import hashlib
+    key = [hierarchical_path(params)]
+    key += [opt for opt in options if not opt.startswith(('--buildpath=', '--sourcepath='))]
+    key += [os.environ.get('EASYBUILD_ROBOT', ''), os.environ.get('EASYBUILD_ROBOT_PATHS', '')]
+    for eb_name in sorted(eb_names):
+        path = eb_name if os.path.exists(eb_name) else catalog_find(eb_name, params)
+        if not path:
+            return None
+        key.append(open(path).read())
+    return os.path.join(os.path.expanduser(params['cache_dir']), 'hierarchical',
+                        '%s.json' % hashlib.sha1('\n'.join(key)).hexdigest())
+
+def hierarchical_installed(eb_names, options, params):
+    """return True if the hierarchical modules of the dependency graph of eb_names (recorded by the last
+       hierarchical_pass) all exist. This does not need easybuild: False if unknown or if one is missing
+    """
+    record = hierarchical_record(eb_names, options, params)
+    try:
+        modules = json.load(open(record))
+    except (TypeError, IOError, ValueError):
+        return False
+    return all(module_exists(module, [hierarchical_path(params) + '/all']) for module in modules)
+
+#
+# tracking of the slurm jobs submitted by 'eb --job'
+#
+SLURM_TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL',
+                         'OUT_OF_MEMORY', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE')
+
+def parse_submitted_jobs(output):
+    """return the slurm jobs (jobid -> name) listed in the output of 'eb --job'
+       ("List of submitted jobs (2): GCC-6.3.0-2.27 (GCC/6.3.0-2.27): 1234, foss-2017a (foss/2017a): 1235")
+    """
+    jobs = {}
+    for line in output.split('\n'):
+        if 'List of submitted jobs' in line:
+            for name, _, jobid in re.findall(r'(\S+) \(([^)]*)\): (\d+)', line.split(':', 1)[1]):
+                jobs[jobid] = name
+        elif re.search(r'Submitted batch job (\d+)', line):
+            jobid = re.search(r'Submitted batch job (\d+)', line).group(1)
+            jobs.setdefault(jobid, jobid)
+    return jobs
+
+def slurm_job_states(job_ids, env=None):
+    """return the state of the slurm jobs (jobid -> state).
+       squeue is used for the jobs still known by slurmctld, sacct for the others.
+       The state is UNKNOWN if neither of them knows the job.
+    """
+    states = {}
+    returncode, stdout = run_capture(['squeue', '-h', '-r', '-j', ','.join(job_ids), '-o', '%i %T'], env)
+    if not returncode:
+        for line in stdout.split('\n'):
+            if line.strip():
+                jobid, state = line.split()[:2]
+                states[jobid] = state
+    missing = [jobid for jobid in job_ids if jobid not in states]
+    if missing:
+        returncode, stdout = run_capture(['sacct', '-n', '-P', '-X', '-j', ','.join(missing),
+                                          '-o', 'JobID,State'], env)
+        for line in stdout.split('\n'):
+            if not returncode and '|' in line:
+                jobid, state = line.split('|')[:2]
+                # e.g. "CANCELLED by 1234"
+                states[jobid] = state.split()[0] if state.strip() else 'UNKNOWN'
+    for jobid in job_ids:
+        states.setdefault(jobid, 'UNKNOWN')
+    return states
+
+def wait_slurm_jobs(jobs, env=None, poll_min=10, poll_max=300, unknown_polls=10):
+    """wait that all the jobs are in a terminal state (or that one of them failed).
+       The polling interval grows from poll_min to poll_max.
+       A job UNKNOWN (squeue and sacct failed or do not know it) is polled again, it is
+       failed after unknown_polls consecutive polls.
+       return the state of the jobs and the list of failed jobs
+    """
+    delay = poll_min
+    states = {}
+    unknown = dict((jobid, 0) for jobid in jobs)
+    while jobs:
+        states = slurm_job_states(sorted(jobs), env)
+        for jobid in jobs:
+            unknown[jobid] = unknown[jobid] + 1 if states[jobid] == 'UNKNOWN' else 0
+        failed = [jobid for jobid in sorted(jobs) if unknown[jobid] >= unknown_polls or
+                  (states[jobid] in SLURM_TERMINAL_STATES and states[jobid] != 'COMPLETED')]
+        if failed:
+            return states, failed
+        if all(state in SLURM_TERMINAL_STATES for state in states.values()):
+            break
+        time.sleep(delay)
+        delay = min(delay * 1.5, poll_max)
+    return states, []
+
+def job_resources(node, params, times, feature):
+    """return the resources of the build job of node (see easyconfig_graph): cores, memory (in GB, 
+       0: not set), walltime (in hour) and partition. job_cores/job_memory and the walltime from the 
+       history of the build times, overwritten by the entry of the software name or of the module in 
+       job_resources. The partition is chosen from the walltime
+    """
+    module = node['module']
+    resources = dict(cores=params['job_cores'], memory=params['job_memory'],
+                     walltime=job_walltime(predict_build_time(times, node['spec'], module, feature), params))
+    overrides = params['job_resources'] or {}
+    resources.update(overrides.get(module.split('/')[0], {}))
+    resources.update(overrides.get(module, {}))
+    resources['partition'], resources['walltime'] = choose_partition(float(resources['walltime']), params)
+    return resources
+
+def sbatch_options(resources, feature, output, name):
+    """return the sbatch options of a build job"""
+    import math
+    options = ['--parsable', '--job-name=%s' % name, '--partition=%s' % resources['partition'],
+               '--output=%s' % output,
+               '--time=%d' % int(math.ceil(float(resources['walltime']) * 60)),
+               '--cpus-per-task=%s' % resources['cores']]
+    if feature:
+        options.append('--constraint=%s' % feature)
+    if resources['memory']:
+        options.append('--mem=%sG' % resources['memory'])
+    return options
+
+def submit_slurm_jobs(nodes, options, env, log_dir, feature, params):
+    """submit with sbatch one job per easyconfig of nodes (see easyconfig_graph). A job depends
+       (afterok) on the jobs of its dependencies, the independent easyconfigs with the same resources
+       are submitted as a single job array. All the jobs are submitted at once so that slurm can
+       schedule (and backfill) the whole stack.
+       return the submitted jobs (jobid or <array jobid>_<index> -> module)
+    """
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+
+    for opt in options:
+        if opt.startswith('--parallel='):
+            params = dict(params, job_cores=int(opt.split('=', 1)[1]))
+    options = [opt for opt in options if not opt.startswith(('--robot=', '--parallel='))]
+    times = load_build_times(params)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    jobs = {}
+    submitted = {}
+    def sbatch(sbatch_opts, script):
+        cmd = ['sbatch'] + sbatch_opts + ['--wrap=%s' % script]
+        returncode, stdout = run_capture(cmd, env)
+        if returncode:
+            # do not leave a partial stack in the queue
+            for jobid in sorted(set(job.split('_')[0] for job in submitted.values())):
+                run_capture(['scancel', jobid], env)
+            raise Exception(' '.join(cmd) + '\n' + stdout)
+        return stdout.strip().split('\n')[-1].split(';')[0]
+
+    # the independent easyconfigs, one job array per set of resources
+    leaves = {}
+    for node in nodes:
+        if not node['deps']:
+            key = tuple(sorted(job_resources(node, params, times, feature).items()))
+            leaves.setdefault(key, []).append(node)
+    for key in sorted(leaves):
+        resources = dict(key)
+        eb_options = ' '.join(quote(opt) for opt in options + ['--parallel=%s' % resources['cores']])
+        group = leaves[key]
+        if len(group) == 1:
+            jobid = sbatch(sbatch_options(resources, feature, os.path.join(log_dir, 'slurm-%j.out'),
+                                          group[0]['module']),
+                           'eb %s %s' % (quote(group[0]['spec']), eb_options))
+            submitted[group[0]['module']] = jobid
         else:
-            return None, None, []
-    
-    return eb_module, eb_to_check, additional_eb_opts
-
-def get_eb_config_path(eb_to_find, from_ebconfig):
-    """return the eb config path"""
-
-    cmd = ['eb' , from_ebconfig, '-Dr']
-    pattern_path = r'CFGS(\d*)=(.+)'
-    pattern_eb = r' \* \[[x ]\] (.+)(%s)(.*)(\.eb)' % eb_to_find
-
-    results = []
+            jobid = sbatch(sbatch_options(resources, feature, os.path.join(log_dir, 'slurm-%A_%a.out'),
+                                          'eb_leaves')
+                           + ['--array=0-%d' % (len(group) - 1)],
+                           'set -- %s; shift $SLURM_ARRAY_TASK_ID; eb "$1" %s' %
+                           (' '.join(quote(node['spec']) for node in group), eb_options))
+            for index, node in enumerate(group):
+                submitted[node['module']] = '%s_%s' % (jobid, index)
+    # the others, in installation order (the jobs of their dependencies are already submitted)
+    for node in nodes:
+        if node['deps']:
+            resources = job_resources(node, params, times, feature)
+            eb_options = ' '.join(quote(opt) for opt in options + ['--parallel=%s' % resources['cores']])
+            submitted[node['module']] = sbatch(
+                sbatch_options(resources, feature, os.path.join(log_dir, 'slurm-%j.out'), node['module'])
+                + ['--dependency=afterok:%s' % ':'.join(submitted[dep] for dep in node['deps']),
+                   '--kill-on-invalid-dep=yes'],
+                'eb %s %s' % (quote(node['spec']), eb_options))
+    for module, jobid in submitted.items():
+        jobs[jobid] = module
+    return jobs
+
+def slurm_job_elapsed(job_ids, env=None):
+    """return the elapsed time (in second) of the completed slurm jobs (jobid -> seconds)"""
+    elapsed = {}
+    if not job_ids:
+        return elapsed
+    returncode, stdout = run_capture(['sacct', '-n', '-P', '-X', '-j', ','.join(job_ids),
+                                      '-o', 'JobID,State,ElapsedRaw'], env)
+    for line in stdout.split('\n'):
+        fields = line.strip().split('|')
+        if not returncode and len(fields) >= 3 and fields[1] == 'COMPLETED' and fields[2].isdigit():
+            elapsed[fields[0]] = int(fields[2])
+    return elapsed
+
+def slurm_job_log(jobid, env=None):
+    """return the output file of a slurm job"""
+    returncode, stdout = run_capture(['scontrol', 'show', 'job', '-o', jobid], env)
+    match = re.search(r'StdOut=(\S+)', stdout)
+    if not returncode and match:
+        return match.group(1)
+    return os.path.join(os.getcwd(), 'slurm-%s.out' % jobid)
+
+def eb_dry_run(eb_names, options, env=None):
+    """run 'eb <eb_names> -Dr' and return the list of easyconfig in the dependency graph
+       (in installation order) as dictionary with the keys
+          - path: the path of the easyconfig
+          - module: the name of the associated module
+          - installed: True if the module is already installed
+    """
+    cmd = ['eb'] + list(eb_names) + ['-Dr'] + [opt for opt in options if opt not in ('-D', '-Dr', '--dry-run')]
+    returncode, stdout = run_capture(cmd, env)
+    if returncode:
+        raise Exception(' '.join(cmd) + '\n' + stdout)
 
-    #print cmd
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     paths = {}
-    text = ""
-    for line in p.stdout:
-        text+=line
-        if re.search(pattern_path, line):
-            pid, position = re.search(pattern_path, line).groups()
-            paths[pid] = position
-        if re.search(pattern_eb, line, re.I):
-            eb_path = ''.join(re.search(pattern_eb, line, re.I).groups())
-            break
+    results = []
+    for line in stdout.split('\n'):
+        match = re.search(r'^CFGS(\d*)=(.+)', line.strip())
+        if match:
+            paths[match.group(1)] = match.group(2)
+            continue
+        match = re.search(r'^\s*\* \[(.)\] (\S+\.eb) \(module: (\S+)\)', line)
+        if match:
+            status, path, module = match.groups()
+            cfgs = re.search(r'^\$CFGS(\d*)', path)
+            if cfgs:
+                path = path.replace(cfgs.group(0), paths[cfgs.group(1)], 1)
+            results.append(dict(path=path, module=module, installed=(status == 'x')))
+    return results
+
+def cached_eb_dry_run(eb_name, options, mod_opts, run=True):
+    """return eb_dry_run([eb_name], options) 
+       The result is kept on disk (cache_dir/dry_run) with a key based on the content of the 
+       easyconfig and on the robot path/options. If the easyconfig can not be located, eb is always run.
+       If run is False, eb is never run (None is returned if the result is not in the cache)
+    """
+    import hashlib
+    if os.path.exists(eb_name):
+        path = eb_name
+    elif os.sep in eb_name:
+        path = None # not written yet (derived easyconfig in check mode)
     else:
-        raise Exception, ' '.join(cmd) + '\n' + text
-
-    if eb_path.startswith('$CFGS'):
-        if re.search('\$CFGS(\d*)', eb_path):
-            pid = re.search('\$CFGS(\d*)', eb_path).groups()[0]
-            eb_path = eb_path.replace('$CFGS%s'%pid, paths[pid])
-    #print [eb_path]
-    return eb_path
+        path = catalog_find(eb_name, mod_opts)
+    if not path:
+        return eb_dry_run([eb_name], options) if run else None
+
+    # options which do not change the resolution are not part of the key
+    robot_path = [opt for opt in options if not opt.startswith(('--buildpath=', '--sourcepath='))]
+    robot_path += [os.environ.get('EASYBUILD_ROBOT', ''), os.environ.get('EASYBUILD_ROBOT_PATHS', '')]
+    key = hashlib.sha1(open(path).read() + '\n'.join(robot_path)).hexdigest()
+    cache_dir = os.path.join(os.path.expanduser(mod_opts['cache_dir']), 'dry_run')
+    cache_file = os.path.join(cache_dir, '%s.json' % key)
+    try:
+        return json.load(open(cache_file))['dependencies']
+    except (IOError, ValueError, KeyError):
+        if not run:
+            return None
+
+    results = eb_dry_run([eb_name], options)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        json.dump(dict(easyconfig=path, robot_path=robot_path, dependencies=results),
+                  open(cache_file + '.tmp', 'w'))
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        pass
+    return results
+
+def build_times_file(params):
+    return os.path.expanduser(params['build_times'] or os.path.join(params['cache_dir'], 'build_times.json'))
+
+def load_build_times(params):
+    """return the history of the build times from build_times (json):
+          <easyconfig>|<toolchain>|<feature> -> list of the last build times (in second)
+       (an entry module -> seconds can also be given by hand)
+    """
+    try:
+        return json.load(open(build_times_file(params)))
+    except (IOError, ValueError):
+        return {}
+
+def build_time_key(easyconfig, feature):
+    """return the key of the history of the build times of an easyconfig on a slurm feature"""
+    easyconfig = os.path.basename(easyconfig)
+    info = parse_eb_name(easyconfig)
+    toolchain = '%(toolchain)s-%(toolchain_version)s' % info if info and info['toolchain'] else 'SYSTEM'
+    return '|'.join([easyconfig, toolchain, feature or ''])
+
+def record_build_times(params, builds, keep=10):
+    """add the builds (easyconfig, feature, seconds) to the history of the build times"""
+    if not builds:
+        return
+    times = load_build_times(params)
+    for easyconfig, feature, seconds in builds:
+        key = build_time_key(easyconfig, feature)
+        times[key] = (times.get(key, []) + [int(seconds)])[-keep:]
+    try:
+        write_atomic(build_times_file(params), json.dumps(times, indent=1, sort_keys=True))
+    except (IOError, OSError):
+        pass
+
+def predict_build_time(times, easyconfig, module, feature):
+    """return the expected build time (in second) of an easyconfig (None if unknown): the longest
+       of the last builds on the same feature, otherwise on any feature, otherwise of any version of
+       the software (or the time given by hand for the module)
+    """
+    easyconfig = os.path.basename(easyconfig)
+    key = build_time_key(easyconfig, feature)
+    if times.get(key):
+        return max(times[key])
+    history = [seconds for name, values in times.items() if name.split('|')[0] == easyconfig
+               and isinstance(values, list) for seconds in values]
+    if history:
+        return max(history)
+    info = parse_eb_name(easyconfig)
+    if info:
+        history = [seconds for name, values in times.items() if isinstance(values, list) and
+                   (parse_eb_name(name.split('|')[0]) or {}).get('name') == info['name'] for seconds in values]
+        if history:
+            return max(history)
+    if isinstance(times.get(module), (int, float)):
+        return times[module]
+    return None
+
+def job_walltime(seconds, params):
+    """return the walltime (in hour) of a job with an expected build time (job_walltime if unknown)"""
+    if seconds is None:
+        return params['job_walltime']
+    # no job shorter than 15 minutes (setup of the build, loading of the modules, ...)
+    return max(seconds * params['walltime_margin'] / 3600., 0.25)
+
+def choose_partition(walltime, params):
+    """return the partition and the walltime (in hour) of a job: the partition of job_partitions with
+       the shortest max_walltime allowing walltime (job_partition if job_partitions is not set)
+    """
+    partitions = sorted(params['job_partitions'], key=lambda partition: float(partition['max_walltime']))
+    if not partitions:
+        return params['job_partition'], walltime
+    for partition in partitions:
+        if walltime <= float(partition['max_walltime']):
+            return partition['name'], walltime
+    return partitions[-1]['name'], float(partitions[-1]['max_walltime'])
+
+def install_plan(eb_names, options, mod_paths, params, feature=''):
+    """return the missing modules of the dependency graph of eb_names (in installation order)
+       without running eb: the graph is taken from the cached dry runs and the modules are looked
+       for in mod_paths. Each entry is a dictionary with
+          - module/easyconfig: the module and its easyconfig
+          - try_options: the --try-* options applied to it (tweaked easyconfig)
+          - dependencies_known: False if the dependencies are unknown (no cached dry run)
+          - estimated_time: build time (in second) from the history of build_times (default_build_time if unknown)
+          - history: True if estimated_time comes from the history
+    """
+    times = load_build_times(params)
+    try_options = [opt for opt in options if opt.startswith('--try-')]
+    robot_paths = [os.path.normpath(path) for path in eb_robot_paths(params['installpath_modules'])]
+    plan = []
+    for eb_name in eb_names:
+        entries = cached_eb_dry_run(eb_name, options, params, run=False)
+        known = entries is not None
+        if not known:
+            entries = [dict(path=eb_name, module=eb_to_module_name(eb_name, strict=False))]
+        for entry in entries:
+            if any(planned['module'] == entry['module'] for planned in plan) or \
+                    module_exists(entry['module'], mod_paths):
+                continue
+            # with --try-*, eb -Dr lists the tweaked easyconfigs (outside of the robot path)
+            tweaked = try_options and (not known or not any(
+                os.path.normpath(entry['path']).startswith(path + os.sep) for path in robot_paths))
+            seconds = predict_build_time(times, entry['path'], entry['module'], feature)
+            plan.append(dict(module=entry['module'], easyconfig=entry['path'],
+                             try_options=try_options if tweaked else [], dependencies_known=known,
+                             estimated_time=params['default_build_time'] if seconds is None else seconds,
+                             history=seconds is not None))
+    return plan
+
+def get_eb_config_path(eb_to_find, from_ebconfig, mod_opts):
+    """return the path of the easyconfig matching eb_to_find in the dependencies of from_ebconfig
+       (in check mode, None if the dependencies are not in the cache of the dry runs)
+    """
 
+    start = time.time()
+    dependencies = cached_eb_dry_run(from_ebconfig, [], mod_opts, run=not mod_opts.get('check_mode'))
+    add_timing('eb_config_path', time.time() - start)
+    if dependencies is None:
+        return None
+    for entry in dependencies:
+        if re.search(eb_to_find, os.path.basename(entry['path']), re.I):
+            return entry['path']
+    raise Exception('no easyconfig matching %s in the dependencies of %s' % (eb_to_find, from_ebconfig))
+
+
+def write_atomic(path, content):
+    """write content in path (through a temporary file in the same directory, then renamed)"""
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass # created by another host
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as out:
+        out.write(content)
+    os.rename(tmp, path)
+
+def derived_easyconfig(function, parameters, parent, locate, edit, params):
+    """return the path of the easyconfig derived (by edit: content -> new content or None) from the
+       upstream easyconfig (found by locate() in the dependencies of the easyconfig parent) and the path
+       of the upstream easyconfig.
+       The derived easyconfigs are stored in <installpath_source or cache_dir>/derived/<hash>/<upstream name>
+       where hash depends on the content of the upstream easyconfig, the function and its parameters.
+       An index (function+parameters -> upstream, derived) allows to skip locate() if neither the parent
+       nor the upstream easyconfig changed (always done if the parent is not in the catalog).
+       In check mode (params['check_mode']), nothing is written: the path of a derived easyconfig not
+       yet written is returned (None, None if the upstream easyconfig can not be located).
+    """
+    import hashlib
+    store = os.path.join(params['installpath_source'] or os.path.expanduser(params['cache_dir']), 'derived')
+    request = json.dumps([function, parameters, eb_robot_paths(params['installpath_modules'])], sort_keys=True)
+    index_file = os.path.join(store, 'index', '%s.json' % hashlib.sha1(request).hexdigest())
+    parent_path = parent if os.path.exists(parent) else catalog_find(parent, params)
+    parent_sha1 = hashlib.sha1(open(parent_path).read()).hexdigest() if parent_path else None
+    try:
+        index = json.load(open(index_file))
+        if parent_sha1 and index['parent_sha1'] == parent_sha1 and \
+                hashlib.sha1(open(index['upstream']).read()).hexdigest() == index['upstream_sha1'] and \
+                os.path.exists(index['derived']):
+            return index['derived'], index['upstream']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    upstream = locate()
+    if not upstream:
+        return None, None
+    content = open(upstream).read()
+    key = hashlib.sha1('\0'.join([content, function, json.dumps(parameters, sort_keys=True)])).hexdigest()
+    path = os.path.join(store, key, os.path.basename(upstream))
+    if params.get('check_mode'):
+        return path, upstream
+    if not os.path.exists(path):
+        new_content = edit(content)
+        if new_content is None:
+            return None, upstream
+        write_atomic(os.path.join(store, key, 'upstream.json'),
+                     json.dumps(dict(upstream=upstream, function=function, parameters=parameters)))
+        write_atomic(path, new_content)
+    write_atomic(index_file, json.dumps(dict(upstream=upstream, derived=path, parent_sha1=parent_sha1,
+                                             upstream_sha1=hashlib.sha1(content).hexdigest())))
+    return path, upstream
 
 def edit_openmpi_for_slurm(params):
 
@@ -553,30 +2256,22 @@ def edit_openmpi_for_slurm(params):
     if not foss_eb.endswith('.eb'):
         foss_eb = '%s.eb'% foss_eb
 
-    openmpi_eb_orig_path = get_eb_config_path('OpenMPI', foss_eb)
-    mod_name = os.path.basename(openmpi_eb_orig_path)
-
-    path_source = params['installpath_source']
-    if path_source:
-        path = '%s/openmpi_for_%s' % (path_source, foss_eb)
-    else:
-        path = '/tmp/openmpi_for_%s' % (foss_eb)
-    if os.path.exists(path):
-        return path, mod_name
-    out = open(path,'w')
-
-
-    done = 0
-    for line in open(openmpi_eb_orig_path):
-        out.write(line)
-        if line.strip().startswith(('configopts=', 'configopts =')):
-            out.write("configopts += \'--with-slurm --with-pmi=/usr/ --with-pmi-libdir=/usr/lib64 \'\n") 
-            done +=1
-
-    if done == 1:
-        return path, mod_name
-    else:
-        return False, mod_name
+    def edit(content):
+        lines = []
+        done = 0
+        for line in content.splitlines(True):
+            lines.append(line)
+            if line.strip().startswith(('configopts=', 'configopts =')):
+                lines.append("configopts += \'--with-slurm --with-pmi=/usr/ --with-pmi-libdir=/usr/lib64 \'\n")
+                done +=1
+        if done == 1:
+            return ''.join(lines)
+
+    path, openmpi_eb_orig_path = derived_easyconfig('edit_openmpi_for_slurm', foss_eb, foss_eb,
+                                                    lambda: get_eb_config_path('OpenMPI', foss_eb, params),
+                                                    edit, params)
+    mod_name = os.path.basename(openmpi_eb_orig_path) if openmpi_eb_orig_path else None
+    return path or False, mod_name
 
 def special_amend(params):
 
@@ -591,24 +2286,16 @@ def special_amend(params):
     if not toolchain.endswith('.eb'):
         toolchain = '%s.eb'% toolchain
 
-    orig_path = get_eb_config_path(name, toolchain)
-    mod_name = os.path.basename(orig_path)
-
-    path_source = params['installpath_source']
-    if path_source:
-        path = '%s/amend_%s' % (path_source, name)
-    else:
-        path = '/tmp/amend_%s' % (name)
-    if os.path.exists(path):
-        return path, mod_name
-
-    from shutil import copyfile
-    copyfile(orig_path, path)
+    def edit(content):
+        if not content.endswith('\n'):
+            content += '\n'
+        for key,value in zip(add_var, add_value):
+            content += "%s = %s \n" % (key, value)
+        return content
 
-    out = open(path,'a')
-    for key,value in zip(add_var, add_value):
-        out.write("%s = %s \n" % (key, value))
-    out.close()
+    path, orig_path = derived_easyconfig('special_amend', params['special_edit_parameters'], toolchain,
+                                         lambda: get_eb_config_path(name, toolchain, params), edit, params)
+    mod_name = os.path.basename(orig_path) if orig_path else None
 
     return path, mod_name
 
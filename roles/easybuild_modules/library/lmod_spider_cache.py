@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+import os
+import re
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.21',
+    'status': ['preview'],
+    'supported_by': 'olivier.mattelaer@uclouvain.be'
+}
+
+DOCUMENTATION = '''
+---
+
+
+short_description: Refresh the Lmod system spider cache of the module trees modified by easybuild
+
+version_added: "2.4"
+
+description:
+    - "Run update_lmod_system_cache_files for the module trees which changed since their
+       cache was built. Each tree has its own cache (<cache_dir>/<tree>/ and its timestamp
+       file), so that only the modified trees are walked again."
+
+options:
+    module_trees:
+        description:
+            - module trees (directories in MODULEPATH) covered by the spider cache
+        required: true
+
+author:
+    - olivier.mattelaer@uclouvain.be
+'''
+
+EXAMPLES = '''
+
+# run once per play from a handler notified by the easybuild tasks
+# (the cache of a tree is only rebuilt if the tree changed)
+- easybuild:
+    package: foss-2017a.eb
+    installpath_modules: "{{ prefix_foss }}/modules"
+  register: eb_foss
+  notify: refresh lmod cache
+
+handlers:
+- name: refresh lmod cache
+  lmod_spider_cache:
+    module_trees: ["{{ prefix_foss }}/modules/all", "{{ prefix_ceci }}/modules/all"]
+    cache_dir: /opt/lmod/cache
+  run_once: true
+
+# full parameter
+- lmod_spider_cache:
+  module_trees: list of module trees (directories of MODULEPATH)
+  cache_dir: directory of the spider caches (one sub-directory per tree, to declare in lmodrc.lua,
+             see sc_descript in the result)
+  touched: (default:all the directories of the trees) directories modified by the play (modules_dir of
+           the easybuild module). Only the trees containing one of them newer than the cache are refreshed
+  lmod_dir: (default:$LMOD_DIR) directory of update_lmod_system_cache_files
+  force: (default:False) refresh the cache of all the trees
+'''
+
+RETURN = '''
+refreshed:
+    description: module trees for which the spider cache was rebuilt
+    type: list
+sc_descript:
+    description: scDescriptT entries of lmodrc.lua for the caches of the trees
+    type: str
+'''
+
+import subprocess
+from ansible.module_utils.basic import AnsibleModule
+
+def run_module():
+    module_args = dict(
+        module_trees=dict(type='list', required=True),
+        cache_dir=dict(type='str', required=True),
+        touched=dict(type='list', required=False, default=[]),
+        lmod_dir=dict(type='str', required=False, default=''),
+        force=dict(type='bool', required=False, default=False),
+        )
+
+    result = dict(
+        changed=False,
+        message='',
+        refreshed=[],
+        stdout='',
+        stderr='',
+    )
+
+    ans_module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    cache_root = ans_module.params['cache_dir']
+    trees = [tree.rstrip('/') for tree in ans_module.params['module_trees']]
+    touched = [path.rstrip('/') for path in ans_module.params['touched']]
+    result['sc_descript'] = sc_descript(trees, cache_root)
+
+    lmod_dir = ans_module.params['lmod_dir'] or os.environ.get('LMOD_DIR', '')
+    update = os.path.join(lmod_dir, 'update_lmod_system_cache_files')
+    if not os.path.isfile(update):
+        return ans_module.fail_json(msg='update_lmod_system_cache_files not found in %s (set lmod_dir)' % lmod_dir,
+                                    **result)
+
+    for tree in trees:
+        cache_dir, timestamp = tree_cache(tree, cache_root)
+        if not ans_module.params['force'] and not tree_modified(tree, timestamp, touched):
+            continue
+        result['refreshed'].append(tree)
+        if ans_module.check_mode:
+            continue
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        p = subprocess.Popen([update, '-d', cache_dir, '-t', timestamp, tree],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode:
+            result['stdout'] = stdout
+            result['stderr'] = stderr
+            return ans_module.fail_json(msg='update_lmod_system_cache_files failed for %s' % tree, **result)
+
+    result['changed'] = bool(result['refreshed'])
+    result['message'] = '%s tree(s) refreshed' % len(result['refreshed'])
+    ans_module.exit_json(**result)
+
+def tree_cache(tree, cache_root):
+    """return the cache directory and the timestamp file of a module tree"""
+    name = re.sub(r'[^\w.-]+', '_', tree.strip('/'))
+    return os.path.join(cache_root, name), os.path.join(cache_root, name + '.timestamp')
+
+def tree_modified(tree, timestamp, touched=()):
+    """return True if the tree changed since the timestamp file was written.
+       If touched is given, only those directories (in the tree) are checked,
+       otherwise all the directories of the tree are.
+    """
+    try:
+        since = os.stat(timestamp).st_mtime
+    except OSError:
+        return True
+    if touched:
+        paths = [path for path in touched if path == tree or path.startswith(tree + '/')]
+    else:
+        paths = (dirpath for dirpath, _, _ in os.walk(tree))
+    for path in paths:
+        try:
+            if os.stat(path).st_mtime > since:
+                return True
+        except OSError:
+            pass
+    return False
+
+def sc_descript(trees, cache_root):
+    """return the scDescriptT table of lmodrc.lua for the caches of the trees"""
+    entries = []
+    for tree in trees:
+        cache_dir, timestamp = tree_cache(tree, cache_root)
+        entries.append('  { dir = "%s", timestamp = "%s" },' % (cache_dir, timestamp))
+    return 'scDescriptT = {\n%s\n}' % '\n'.join(entries)
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()